@@ -3,20 +3,49 @@ This is the entrypoint to the app. We use the Mangum adapter
 to handle AWS Lambda requests and route them to the corresponding FastAPI route
 """
 
+import json
+
 import logging
 
+from contextlib import asynccontextmanager
+
 from dotenv import load_dotenv
 
 from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
 
 from pydantic import BaseModel
 
-from services.storage import configure_storage
-from services.chat import generate_response
+from services.storage import configure_storage, start_cleanup_sweeper
+from services.chat import generate_response, stream_response, load_assistant_config
+from services.search import close_http_client
+from services.warmer import start_cache_warmer
+from services.whatsapp import start_senders, stop_senders
 
 from routes.webhook import router
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # cache the assistant definition so it isn't retrieved on every message
+    await load_assistant_config()
+
+    # keep popular searches cached, if CACHE_WARM_INTERVAL is set
+    warmer = start_cache_warmer()
+
+    # deliver Whatsapp replies from an outbound queue
+    start_senders()
+
+    yield
+
+    if warmer is not None:
+        warmer.cancel()
+
+    await stop_senders()
+
+    await close_http_client()
+
+
 def create_app():
     # ensure env is loaded
     load_dotenv()
@@ -31,10 +60,11 @@ def create_app():
     logging.getLogger("openai").setLevel(logging.WARNING)
     logging.getLogger("httpx").setLevel(logging.WARNING)
 
-    # configure storage
+    # configure storage and remove expired threads in the background
     configure_storage()
+    start_cleanup_sweeper()
 
-    app = FastAPI()
+    app = FastAPI(lifespan=lifespan)
 
     app.include_router(router)
 
@@ -67,7 +97,7 @@ class ChatRequestBody(BaseModel):
 
 # this route is for regular chat messages sent from anywhere other than Whatsapp, e.g. the Laurus Education website
 @app.post("/chat")
-def chat(
+async def chat(
     body: ChatRequestBody,
     request: Request
 ):
@@ -76,8 +106,35 @@ def chat(
     else:
         _id = request.client.host
 
-    response = generate_response(body.message, _id, body.name)
+    response = await generate_response(body.message, _id, body.name)
 
     return {
         "message": response
     }
+
+
+# same as /chat, but the response is streamed back as Server-Sent Events while it is generated
+@app.post("/chat/stream")
+async def chat_stream(
+    body: ChatRequestBody,
+    request: Request
+):
+    if body.customer_id:
+        _id = body.customer_id
+    else:
+        _id = request.client.host
+
+    async def events():
+        async for delta in stream_response(body.message, _id, body.name):
+            yield f"data: {json.dumps({'message': delta})}\n\n"
+
+        yield "event: done\ndata: {}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no", # stop proxies from buffering the stream
+        },
+    )
@@ -10,6 +10,7 @@ import logging
 from fastapi import APIRouter, Request, HTTPException, BackgroundTasks
 
 from services.whatsapp import process_whatsapp_message
+from services.idempotency import claim_message_async
 
 from dotenv import load_dotenv
 
@@ -74,7 +75,7 @@ def get_webhook(
     "/webhook",
     status_code = 200 # Whatsapp will ping this endpoint until it receives a 200 status code
 )
-def post_webhook(
+async def post_webhook(
     body: Dict[str, Any],
     background_tasks: BackgroundTasks
 ):
@@ -83,6 +84,14 @@ def post_webhook(
         return "OK"
 
     if is_valid_whatsapp_message(body):
+        # Whatsapp may deliver the same message more than once, only the first delivery is processed
+        message_id = body["entry"][0]["changes"][0]["value"]["messages"][0].get("id")
+
+        if message_id is not None and not await claim_message_async(message_id):
+            logger.info("Received duplicate message")
+            return "OK"
+
+        # process_whatsapp_message is async, so the background task runs on the event loop rather than a worker thread
         background_tasks.add_task(process_whatsapp_message, body)
         return "OK"
     else:
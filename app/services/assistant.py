@@ -0,0 +1,134 @@
+"""
+This module caches the OpenAI Assistant definition so it doesn't need to be retrieved on every message
+"""
+import os
+
+import time
+
+import hashlib
+
+import logging
+
+from dataclasses import dataclass, replace
+
+from openai import AsyncOpenAI
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# How long the cached assistant definition is used before it is retrieved again
+ASSISTANT_CONFIG_TTL_SECONDS = float(os.getenv("ASSISTANT_CONFIG_TTL", 600))
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class AssistantConfig:
+    """
+    The parts of the assistant definition the app relies on
+    """
+    id: str
+    model: str
+    # names of the function tools enabled on the assistant
+    tools: frozenset[str]
+    # hash of the system instructions, used to detect changes without logging the full prompt
+    instructions_hash: str
+    loaded_at: float
+
+    @classmethod
+    def from_assistant(cls, assistant):
+        return cls(
+            id=assistant.id,
+            model=assistant.model,
+            tools=frozenset(
+                tool.function.name for tool in assistant.tools
+                if tool.type == "function"
+            ),
+            instructions_hash=hashlib.sha256((assistant.instructions or "").encode()).hexdigest(),
+            loaded_at=time.monotonic(),
+        )
+
+
+class AssistantConfigCache:
+    """
+    Holds the assistant definition and refreshes it once the TTL has passed, or on demand via refresh().
+    """
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        assistant_id: str,
+        ttl: float = ASSISTANT_CONFIG_TTL_SECONDS,
+        supported_tools: set[str] | None = None, # tools the app has handlers for
+    ):
+        self._client = client
+        self._assistant_id = assistant_id
+        self._ttl = ttl
+        self._supported_tools = supported_tools
+
+        self._config: AssistantConfig | None = None
+
+    def _check_drift(self, previous: AssistantConfig | None, config: AssistantConfig):
+        if self._supported_tools is not None:
+            unsupported = config.tools - self._supported_tools
+
+            if unsupported:
+                logger.warning(f"Assistant has tools without a handler: {sorted(unsupported)}")
+
+        if previous is None:
+            return
+
+        if previous.model != config.model:
+            logger.warning(f"Assistant model changed from {previous.model} to {config.model}")
+
+        if previous.tools != config.tools:
+            logger.warning(f"Assistant tools changed from {sorted(previous.tools)} to {sorted(config.tools)}")
+
+        if previous.instructions_hash != config.instructions_hash:
+            logger.warning("Assistant instructions changed")
+
+    async def refresh(self, timeout: float | None = None) -> AssistantConfig:
+        """
+        Retrieve the assistant definition and replace the cached config.
+        If a timeout is given the request is made once, without the client's retries, and must complete within it.
+        """
+        client = self._client if timeout is None else self._client.with_options(max_retries=0, timeout=timeout)
+
+        assistant = await client.beta.assistants.retrieve(self._assistant_id)
+
+        config = AssistantConfig.from_assistant(assistant)
+
+        previous = self._config
+        self._config = config
+
+        self._check_drift(previous, config)
+
+        return config
+
+    async def get(self, timeout: float | None = None) -> AssistantConfig:
+        """
+        Return the cached config, refreshing it if it has expired.
+        If a refresh fails the previous config continues to be used.
+        """
+        config = self._config
+
+        if config is not None and time.monotonic() - config.loaded_at < self._ttl:
+            return config
+
+        try:
+            return await self.refresh(timeout)
+
+        except Exception as e:
+            if config is None:
+                raise
+
+            logger.error(f"Error refreshing assistant config, using cached config instead: {e}")
+
+            # keep using the cached config for another TTL rather than retrying on every message
+            config = replace(config, loaded_at=time.monotonic())
+
+            self._config = config
+
+            return config
@@ -0,0 +1,273 @@
+"""
+This module provides the persistent caches used by search.
+Entries are stored in SQLite so they survive restarts and are shared between worker processes on the same machine.
+"""
+import os
+
+import json
+
+import time
+
+import asyncio
+
+import threading
+
+from functools import lru_cache
+
+from services.storage import DIRECTORY, connect_sqlite
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# Path of the cache database. Set to a shared volume (e.g. EFS) to share the cache between machines
+CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", f"{DIRECTORY}/search_cache.db")
+
+# How long search results are used before they are searched again, and how many are kept
+SEARCH_CACHE_TTL_SECONDS = float(os.getenv("SEARCH_CACHE_TTL", 24 * 60 * 60))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 1000))
+
+# Text extracted from each page is kept for PAGE_CACHE_TTL so it can be revalidated with a conditional request,
+# see PAGE_MAX_AGE in services/search.py for how long it is used without revalidating
+PAGE_CACHE_TTL_SECONDS = float(os.getenv("PAGE_CACHE_TTL", 7 * 24 * 60 * 60))
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", 2000))
+
+# Queries that haven't been searched for within QUERY_STATS_WINDOW are no longer counted, see services/warmer.py
+QUERY_STATS_WINDOW_SECONDS = float(os.getenv("QUERY_STATS_WINDOW", 7 * 24 * 60 * 60))
+
+# Summaries are keyed on a hash of the content they were made from, so they don't go stale when pages change.
+# The TTL and maximum entries only limit the size of the cache
+SUMMARY_CACHE_TTL_SECONDS = float(os.getenv("SUMMARY_CACHE_TTL", 30 * 24 * 60 * 60))
+SUMMARY_CACHE_MAX_ENTRIES = int(os.getenv("SUMMARY_CACHE_MAX_ENTRIES", 2000))
+
+
+class SQLiteCache:
+    """
+    Key value cache with a TTL per entry, least recently used eviction once max_entries is reached, and hit/miss counters.
+    Values are stored as JSON. Each cache is a table in the cache database.
+    """
+    def __init__(
+        self,
+        name: str, # table name
+        ttl: float,
+        max_entries: int,
+        path: str = CACHE_PATH,
+    ):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._conn = connect_sqlite(path)
+        self._conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_accessed_at ON {name} (accessed_at)")
+        self._conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_expires_at ON {name} (expires_at)")
+        # counters are kept in the database so hit rates cover every worker
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS cache_stats (
+                cache TEXT NOT NULL,
+                name TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                PRIMARY KEY (cache, name)
+            )
+        """)
+
+        self._lock = threading.Lock()
+
+    def record(self, counter: str):
+        """
+        Increment a named counter, included in stats()
+        """
+        with self._lock:
+            self._increment(counter)
+
+    def _increment(self, counter: str):
+        self._conn.execute(
+            "INSERT INTO cache_stats (cache, name, count) VALUES (?, ?, 1) ON CONFLICT (cache, name) DO UPDATE SET count = count + 1",
+            (self.name, counter),
+        )
+
+    def get(
+        self,
+        key: str,
+        record_stats: bool = True, # set to False to record hits and misses with record() instead
+    ):
+        """
+        Returns the cached value, or None if there is no entry or it has expired
+        """
+        now = time.time()
+
+        with self._lock:
+            row = self._conn.execute(f"SELECT value FROM {self.name} WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+
+            if row is None:
+                if record_stats:
+                    self._increment("misses")
+
+                return None
+
+            self._conn.execute(f"UPDATE {self.name} SET accessed_at = ? WHERE key = ?", (now, key))
+
+            if record_stats:
+                self._increment("hits")
+
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: float | None = None):
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + (ttl if ttl is not None else self.ttl), now),
+            )
+            self._evict(now)
+
+    def expires_at(self, key: str) -> float | None:
+        """
+        Returns when the entry expires as a timestamp, or None if there is no entry
+        """
+        with self._lock:
+            row = self._conn.execute(f"SELECT expires_at FROM {self.name} WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+
+        return row[0] if row is not None else None
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {self.name} WHERE key = ?", (key,))
+
+    def keys(self) -> list[str]:
+        with self._lock:
+            return [key for (key,) in self._conn.execute(f"SELECT key FROM {self.name} WHERE expires_at > ?", (time.time(),))]
+
+    def _evict(self, now: float):
+        self._conn.execute(f"DELETE FROM {self.name} WHERE expires_at <= ?", (now,))
+
+        (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()
+
+        if count > self.max_entries:
+            self._conn.execute(
+                f"DELETE FROM {self.name} WHERE key IN (SELECT key FROM {self.name} ORDER BY accessed_at LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(self._conn.execute("SELECT name, count FROM cache_stats WHERE cache = ?", (self.name,)).fetchall())
+            (entries,) = self._conn.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()
+
+        # hits on a similar entry (see services/query.py), searches shared with a concurrent caller (see services/singleflight.py)
+        # and pages revalidated without downloading them count towards the hit rate
+        hits = sum(counters.get(counter, 0) for counter in ("hits", "similar_hits", "shared_hits", "revalidated"))
+        misses = counters.get("misses", 0)
+
+        return {
+            **counters,
+            "lookups": hits + misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else 0.0,
+            "entries": entries,
+        }
+
+    # Async variants for use from the event loop, sqlite3 is blocking so calls run in a worker thread
+
+    async def get_async(self, key: str, record_stats: bool = True):
+        return await asyncio.to_thread(self.get, key, record_stats)
+
+    async def record_async(self, counter: str):
+        await asyncio.to_thread(self.record, counter)
+
+    async def set_async(self, key: str, value, ttl: float | None = None):
+        await asyncio.to_thread(self.set, key, value, ttl)
+
+    async def expires_at_async(self, key: str) -> float | None:
+        return await asyncio.to_thread(self.expires_at, key)
+
+    async def stats_async(self) -> dict:
+        return await asyncio.to_thread(self.stats)
+
+
+class QueryStats:
+    """
+    Counts how often each normalised query is searched for, with the most recent wording of each.
+    Queries that haven't been searched for within window seconds are forgotten.
+    """
+    def __init__(
+        self,
+        window: float = QUERY_STATS_WINDOW_SECONDS,
+        path: str = CACHE_PATH,
+    ):
+        self.window = window
+
+        self._conn = connect_sqlite(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS query_stats (
+                key TEXT PRIMARY KEY,
+                query TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                last_seen REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS query_stats_count ON query_stats (count)")
+
+        self._lock = threading.Lock()
+
+    def record(self, key: str, query: str):
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO query_stats (key, query, count, last_seen) VALUES (?, ?, 1, ?)
+                ON CONFLICT (key) DO UPDATE SET query = excluded.query, count = count + 1, last_seen = excluded.last_seen
+                """,
+                (key, query, time.time()),
+            )
+
+    def top(self, n: int) -> list[tuple[str, str]]:
+        """
+        Returns the key and query of the n most frequent queries
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM query_stats WHERE last_seen < ?", (time.time() - self.window,))
+
+            return self._conn.execute("SELECT key, query FROM query_stats ORDER BY count DESC, last_seen DESC LIMIT ?", (n,)).fetchall()
+
+    async def record_async(self, key: str, query: str):
+        await asyncio.to_thread(self.record, key, query)
+
+    async def top_async(self, n: int) -> list[tuple[str, str]]:
+        return await asyncio.to_thread(self.top, n)
+
+
+@lru_cache(maxsize=1)
+def get_search_cache() -> SQLiteCache:
+    """
+    Cache of (search results, summary) for each query
+    """
+    return SQLiteCache("search_cache", ttl=SEARCH_CACHE_TTL_SECONDS, max_entries=SEARCH_CACHE_MAX_ENTRIES)
+
+
+@lru_cache(maxsize=1)
+def get_page_cache() -> SQLiteCache:
+    """
+    Cache of text extracted from each page with its ETag and Last-Modified validators, keyed by url
+    """
+    return SQLiteCache("page_cache", ttl=PAGE_CACHE_TTL_SECONDS, max_entries=PAGE_CACHE_MAX_ENTRIES)
+
+
+@lru_cache(maxsize=1)
+def get_summary_cache() -> SQLiteCache:
+    """
+    Cache of summaries, keyed by a hash of the normalised query and the page content that was summarised
+    """
+    return SQLiteCache("summary_cache", ttl=SUMMARY_CACHE_TTL_SECONDS, max_entries=SUMMARY_CACHE_MAX_ENTRIES)
+
+
+@lru_cache(maxsize=1)
+def get_query_stats() -> QueryStats:
+    return QueryStats()
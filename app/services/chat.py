@@ -5,16 +5,20 @@ import os
 
 import json
 
+import asyncio
+
 import logging
 
 from datetime import datetime
 
-from openai import OpenAI, BadRequestError
+from openai import AsyncOpenAI, BadRequestError, NotFoundError, APITimeoutError, DefaultAsyncHttpxClient
 
-from services.storage import get_item_if_exists, store_thread as store_thread_in_db, update_thread as update_thread_in_db
+from services.storage import get_item_if_exists_async, store_thread_async as store_thread_in_db, update_thread_async as update_thread_in_db
 
 from services.search import search_tool
 from services.tools import application_form_tool
+from services.assistant import AssistantConfigCache
+from services.metrics import track_openai_calls, record_openai_request
 
 from dotenv import load_dotenv
 
@@ -29,10 +33,70 @@ OPENAI_ASSISTANT_ID = os.getenv("OPENAI_ASSISTANT_ID")
 # the bot to determine whether they are prospective or existing
 STUDENT_TYPE_MESSAGE = """Hi, thank you for your message. To help me assist you with your query, please confirm whether you are an existing student with Laurus Education. Please reply with \"YES\" or \"NO\""""
 
+# End-to-end time budget for responding to a message, covering runs, tool calls and polling.
+# Must leave headroom under the 120 second Lambda timeout in template.yaml
+RUN_TIMEOUT_SECONDS = float(os.getenv("RUN_TIMEOUT", 100))
+
+# Tool calls requested in the same step are run concurrently, each with its own timeout
+TOOL_CALL_TIMEOUT_SECONDS = float(os.getenv("TOOL_CALL_TIMEOUT", 30))
+MAX_CONCURRENT_TOOL_CALLS = int(os.getenv("MAX_CONCURRENT_TOOL_CALLS", 4))
+
+# Tool output used when a tool fails, prompting the model to apologise and direct the user to a human
+TOOL_ERROR_OUTPUT = "There is something wrong with the tool at the moment. Apologise to the user and direct them to contact a human."
+
+# Messages returned when a response could not be generated
+BUSY_MESSAGE = "Please wait while I look into your query."
+ERROR_MESSAGE = "Something went wrong processing your request, please try again later or contact a human for support."
+TIMEOUT_MESSAGE = "Sorry, this is taking longer than expected. Please try again shortly or contact a human for support."
+
 
 logger = logging.getLogger()
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = AsyncOpenAI(
+    api_key=OPENAI_API_KEY,
+    # count requests so the number of OpenAI calls per message can be measured
+    http_client=DefaultAsyncHttpxClient(event_hooks={"request": [record_openai_request]}),
+)
+
+# Tools the dispatcher below knows how to handle
+SUPPORTED_TOOLS = {"search_knowledge", "get_application_form"}
+
+# Client for requests made under a response's deadline. These aren't retried, as each retry would get the full timeout
+# again and could run past the deadline, and a retried run create could start a second run on the thread
+deadline_client = client.with_options(max_retries=0)
+
+assistant_config = AssistantConfigCache(client, OPENAI_ASSISTANT_ID, supported_tools=SUPPORTED_TOOLS)
+
+
+async def load_assistant_config():
+    """
+    Load the assistant definition at startup. If this fails it will be loaded on first use instead.
+    """
+    try:
+        config = await assistant_config.refresh()
+
+        logger.info(f"Loaded assistant {config.id} using model {config.model} with tools {sorted(config.tools)}")
+
+    except Exception as e:
+        logger.error(f"Error loading assistant config: {e}")
+
+
+def get_deadline(timeout: float = RUN_TIMEOUT_SECONDS) -> float:
+    """
+    Returns the event loop time by which a response must be complete
+    """
+    return asyncio.get_running_loop().time() + timeout
+
+
+def time_remaining(deadline: float) -> float:
+    return max(deadline - asyncio.get_running_loop().time(), 0)
+
+
+async def within_deadline(awaitable, deadline: float):
+    """
+    Await a request, raising TimeoutError if it doesn't complete before the deadline
+    """
+    return await asyncio.wait_for(awaitable, timeout=time_remaining(deadline))
 
 
 def get_student_type_from_user_message(
@@ -53,163 +117,361 @@ def get_student_type_from_user_message(
     return "unknown"
 
 
-def create_and_store_thread(
-    _id: str # primary key to store thread under
+async def retrieve_thread(
+    thread_id: str
 ):
-    thread = client.beta.threads.create()
+    thread = await client.beta.threads.retrieve(thread_id)
+    return thread.id
 
-    store_thread_in_db(_id, thread.id)
 
-    return thread
+async def call_tool(
+    tool, # tool call from run.required_action
+    enabled_tools: frozenset[str] | None,
+) -> str:
+    if enabled_tools is not None and tool.function.name not in enabled_tools:
+        logger.warning(f"Assistant called tool '{tool.function.name}' which is not in its cached definition")
 
+    arguments = json.loads(tool.function.arguments)
 
-def retrieve_thread(
-    thread_id: str
-):
-    thread = client.beta.threads.retrieve(thread_id)
-    return thread.id
+    match tool.function.name:
+        case "search_knowledge":
+            query = arguments.get("query")
 
+            if not query:
+                raise ValueError("Argument 'query' was not provided")
 
-def handle_tool_calls(
-    run # run object from client.beta.threads.run.create
-):
-    tool_outputs = []
+            return await search_tool(query, arguments.get("college"))
 
-    if run.required_action:
-        for tool in run.required_action.submit_tool_outputs.tool_calls:
-            try:
-                arguments = json.loads(tool.function.arguments)
+        case "get_application_form":
+            college = arguments.get("college")
 
-                match tool.function.name:
-                    case "search_knowledge":
-                        query = arguments.get("query")
+            if not college:
+                raise ValueError("Argument 'college' was not provided")
 
-                        if not query:
-                            raise ValueError("Argument 'query' was not provided")
+            return application_form_tool(college)
 
-                        tool_outputs.append({
-                            "tool_call_id": tool.id,
-                            "output": search_tool(query)
-                        })
+        case _:
+            raise ValueError(f"Unknown tool '{tool.function.name}'")
 
-                    case "get_application_form":
-                        college = arguments.get("college")
 
-                        if not college:
-                            raise ValueError("Argument 'college' was not provided")
+async def handle_tool_call(
+    tool,
+    enabled_tools: frozenset[str] | None,
+    semaphore: asyncio.Semaphore,
+    deadline: float,
+):
+    try:
+        async with semaphore:
+            # tool calls can't run past the deadline for the whole response
+            timeout = min(TOOL_CALL_TIMEOUT_SECONDS, time_remaining(deadline))
 
-                        tool_outputs.append({
-                            "tool_call_id": tool.id,
-                            "output": application_form_tool(college)
-                        })
+            output = await asyncio.wait_for(call_tool(tool, enabled_tools), timeout=timeout)
 
-            except Exception as e:
-                logger.error("Error handling tool calls: ", e)
+    except Exception as e:
+        logger.error(f"Error handling tool call '{tool.function.name}': {e!r}")
 
-                # prompt the model to apologise to the user and direct them to a human
-                tool_outputs.append({
-                    "tool_call_id": tool.id,
-                    "output": "There is something wrong with the tool at the moment. Apologise to the user and direct them to contact a human."
-                })
+        # prompt the model to apologise to the user and direct them to a human
+        output = TOOL_ERROR_OUTPUT
 
-    return tool_outputs
+    return {
+        "tool_call_id": tool.id,
+        "output": output,
+    }
 
 
-def run_assistant(thread_id, name):
+async def handle_tool_calls(
+    run, # run object from client.beta.threads.run.create
+    deadline: float,
+):
     """
-    This function runs the assistant, handles any tool calls, and returns the response as a string
+    Run the tool calls the assistant asked for concurrently. Each call has its own timeout and
+    failures only affect that call, so a step takes as long as its slowest tool.
     """
-    # retrieve assistant
-    assistant = client.beta.assistants.retrieve(OPENAI_ASSISTANT_ID)
+    if not run.required_action:
+        return []
+
+    try:
+        # the config is only refreshed here once its TTL has passed, the refresh is bounded by the deadline like any other request
+        enabled_tools = (await within_deadline(assistant_config.get(timeout=time_remaining(deadline)), deadline)).tools
+
+    except Exception as e:
+        logger.warning(f"Assistant config is unavailable, tool calls will not be checked against it: {e}")
+
+        enabled_tools = None
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_TOOL_CALLS)
+
+    return list(await asyncio.gather(*[
+        handle_tool_call(tool, enabled_tools, semaphore, deadline)
+        for tool in run.required_action.submit_tool_outputs.tool_calls
+    ]))
 
+
+def get_additional_instructions(name: str | None):
     additional_instructions = f"Today's date is {datetime.now().strftime('%A, %#d %B %Y')}."
 
     # add user name to thread if it is provided
     if name is not None:
         additional_instructions += f" You are now having a conversation with {name}"
 
-    # run this assistant and wait until terminal state
-    # https://platform.openai.com/docs/assistants/tools/function-calling?example=without-streaming
-    run = client.beta.threads.runs.create_and_poll(
-        thread_id=thread_id,
-        assistant_id=assistant.id,
-        additional_instructions=additional_instructions,
-        timeout=60,
-    )
-
-    tool_outputs = handle_tool_calls(run)
-
-    if len(tool_outputs) > 0:
-        run = client.beta.threads.runs.submit_tool_outputs_and_poll(
-            thread_id=thread_id,
-            run_id=run.id,
-            tool_outputs=tool_outputs,
-            timeout=60,
+    return additional_instructions
+
+
+async def iterate_until(stream, deadline: float):
+    """
+    Iterate over a run stream, raising TimeoutError if the next event doesn't arrive before the deadline
+    """
+    iterator = aiter(stream)
+
+    while True:
+        try:
+            event = await asyncio.wait_for(anext(iterator), timeout=time_remaining(deadline))
+
+        except StopAsyncIteration:
+            return
+
+        yield event
+
+
+async def cancel_run(thread_id: str, run_id: str):
+    try:
+        # the deadline may already have passed, give the cancel request a short timeout of its own
+        await client.beta.threads.runs.cancel(run_id=run_id, thread_id=thread_id, timeout=5)
+
+        logger.info(f"Cancelled run {run_id}")
+
+    except Exception as e:
+        logger.warning(f"Error cancelling run {run_id}: {e}")
+
+
+async def create_run(
+    _id: str,
+    record: dict, # user's record from the store
+    message: str,
+    name: str | None,
+    deadline: float,
+):
+    """
+    Create a streaming run on the user's thread, with their message attached to the run rather than added in a separate call.
+    The thread is only created here, on the first message that actually runs the assistant, and any messages buffered
+    in the store (i.e. the student type exchange) are attached to the run along with the user's message.
+    The thread id from the store is trusted, it is only replaced if the run can't be created because the thread no longer exists.
+    New threads are stored as soon as they are created, so they are reused if the run can't be created.
+    Returns the thread id the run was created on and the run stream.
+    """
+    thread_id = record.get("thread_id")
+    pending_messages = record.get("pending_messages") or []
+
+    messages = [
+        *pending_messages,
+        {"role": "user", "content": message},
+    ]
+
+    async def create(thread_id: str):
+        # https://platform.openai.com/docs/assistants/tools/function-calling?example=streaming
+        return await within_deadline(
+            deadline_client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=OPENAI_ASSISTANT_ID, # no need to retrieve the assistant, the id is all that is required
+                additional_instructions=get_additional_instructions(name),
+                additional_messages=messages,
+                stream=True,
+                timeout=time_remaining(deadline),
+            ),
+            deadline,
         )
 
-        if run.status != "completed":
-            raise Exception("Submitting tool outputs failed")
+    async def create_thread() -> str:
+        thread = await within_deadline(deadline_client.beta.threads.create(timeout=time_remaining(deadline)), deadline)
 
-    messages = client.beta.threads.messages.list(thread_id=thread_id)
+        # buffered messages are kept until a run on the thread has been created
+        await store_thread_in_db(_id, thread.id, record.get("student_type"), pending_messages)
 
-    return messages.data[0].content[0].text.value
+        return thread.id
 
+    if thread_id is None:
+        thread_id = await create_thread()
 
-def generate_response(
-    query: str,
-    _id: str, # either Whatsapp user id, user's ip address, or any other unique id passed through the /chat endpoint
-    name: str | None = None
+    try:
+        stream = await create(thread_id)
+
+    except NotFoundError:
+        logger.warning(f"Thread for {_id} no longer exists, creating new thread instead")
+
+        thread_id = await create_thread()
+
+        stream = await create(thread_id)
+
+    # buffered messages are now part of the thread
+    if pending_messages:
+        await store_thread_in_db(_id, thread_id, record.get("student_type"))
+
+    return thread_id, stream
+
+
+async def stream_assistant(
+    _id: str,
+    record: dict, # user's record from the store
+    message: str, # user message to run the assistant on
+    name: str | None,
+    deadline: float | None = None, # event loop time by which the response must be complete
 ):
+    """
+    This function runs the assistant with streaming and yields the response text as it is generated.
+    Tool calls are handled inline as the run asks for them, for as many rounds as the run needs.
+    The response is read from the stream, so the thread's messages don't need to be listed afterwards.
+    If the deadline passes the run is cancelled and TimeoutError is raised. The run is also cancelled if streaming stops
+    for any other reason, e.g. a /chat/stream client disconnecting.
+    """
+    if deadline is None:
+        deadline = get_deadline()
+
+    thread_id = record.get("thread_id")
+    # id of the run while it is active, reset once the run has ended
+    run_id = None
+
     try:
-        # Check if there is already a record for the corresponding id
-        record = get_item_if_exists(_id)
+        thread_id, stream = await create_run(_id, record, message, name, deadline)
+
+        while stream is not None:
+            # stream to continue with once tool outputs have been submitted
+            next_stream = None
+
+            async with stream:
+                async for event in iterate_until(stream, deadline):
+                    match event.event:
+                        case "thread.run.created":
+                            run_id = event.data.id
+
+                        case "thread.message.delta":
+                            for content in event.data.delta.content or []:
+                                if content.type == "text" and content.text and content.text.value:
+                                    yield content.text.value
+
+                        case "thread.run.requires_action":
+                            run = event.data
+                            run_id = run.id
+
+                            tool_outputs = await handle_tool_calls(run, deadline)
+
+                            next_stream = await within_deadline(
+                                deadline_client.beta.threads.runs.submit_tool_outputs(
+                                    thread_id=thread_id,
+                                    run_id=run.id,
+                                    tool_outputs=tool_outputs,
+                                    stream=True,
+                                    timeout=time_remaining(deadline),
+                                ),
+                                deadline,
+                            )
+
+                        case "thread.run.completed":
+                            run_id = None
+
+                        case "thread.run.failed" | "thread.run.cancelled" | "thread.run.expired" | "thread.run.incomplete":
+                            run_id = None
+
+                            raise Exception(f"Run ended with status '{event.data.status}'")
 
-        # If a thread doesn't exist, create one and store it
-        if record is None:
-            thread = create_and_store_thread(_id)
-            student_type = None
+                        case "error":
+                            raise Exception(f"Run stream returned an error: {event.data}")
 
-        # Otherwise, retrieve the existing thread
-        else:
-            student_type = record.get("student_type", None)
+            stream = next_stream
 
-            try:
-                thread = client.beta.threads.retrieve(record.get("thread_id"))
+    except (TimeoutError, APITimeoutError):
+        logger.warning(f"Run on thread {thread_id} did not complete before the deadline")
 
-            except Exception as e:
-                logger.warning(f"Error retreiving thread with id {_id}, creating new thread instead")
+        raise TimeoutError("Run did not complete before the deadline")
 
-                thread = create_and_store_thread(_id)
+    finally:
+        # cancel the run so the thread is not left locked by an active run.
+        # Shielded so the cancel is still sent when the task streaming the response has itself been cancelled
+        if run_id is not None:
+            await asyncio.shield(cancel_run(thread_id, run_id))
 
-        # add user message to thread
-        client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=query,
+
+async def run_assistant(_id, record, message, name, deadline: float | None = None):
+    """
+    This function runs the assistant, handles any tool calls, and returns the response as a string
+    """
+    response = "".join([delta async for delta in stream_assistant(_id, record, message, name, deadline)])
+
+    if not response:
+        raise Exception("Assistant did not return a response")
+
+    return response
+
+
+async def prepare_thread(
+    query: str,
+    _id: str,
+):
+    """
+    Get the user's record, handling the student type exchange locally.
+    Returns the record to run the assistant with, or a reply if the assistant does not need to be run for this message.
+    """
+    # Check if there is already a record for the corresponding id
+    record = await get_item_if_exists_async(_id)
+
+    # If student type has not been determined, send a custom message.
+    # The exchange is buffered in the store rather than sent to OpenAI, it is added to the thread when the assistant is first run
+    if record is None or record.get("student_type") is None:
+        pending_messages = [
+            *((record.get("pending_messages") or []) if record else []),
+            {"role": "user", "content": query},
+            {"role": "assistant", "content": STUDENT_TYPE_MESSAGE},
+        ]
+
+        await store_thread_in_db(
+            _id,
+            record.get("thread_id") if record else None,
+            "pending",
+            pending_messages,
         )
 
-        # If student type has not been determined, send a custom message
-        if student_type is None:
-            # Update student type to "pending" in database
-            update_thread_in_db(_id, "pending")
+        return None, STUDENT_TYPE_MESSAGE
+
+    # Determine student type from response and update database
+    if record.get("student_type") == "pending":
+        student_type = get_student_type_from_user_message(query)
+
+        await update_thread_in_db(_id, student_type)
+
+        record["student_type"] = student_type
+
+    return record, None
+
 
-            # Add the bot's response to thread history before returning
-            client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="assistant",
-                content=STUDENT_TYPE_MESSAGE,
-            )
+async def generate_response(
+    query: str,
+    _id: str, # either Whatsapp user id, user's ip address, or any other unique id passed through the /chat endpoint
+    name: str | None = None,
+    timeout: float = RUN_TIMEOUT_SECONDS, # time budget for the response, see RUN_TIMEOUT
+):
+    deadline = get_deadline(min(timeout, RUN_TIMEOUT_SECONDS))
 
-            return STUDENT_TYPE_MESSAGE
+    with track_openai_calls() as openai_calls:
+        try:
+            return await _generate_response(query, _id, name, deadline)
 
-        # Determine student type from response and update database
-        if student_type == "pending":
-            student_type = get_student_type_from_user_message(query)
+        finally:
+            logger.info(f"OpenAI calls for message: {openai_calls.total()} {dict(openai_calls)}")
 
-            update_thread_in_db(_id, student_type)
+
+async def _generate_response(
+    query: str,
+    _id: str,
+    name: str | None,
+    deadline: float,
+):
+    try:
+        record, reply = await prepare_thread(query, _id)
+
+        if reply is not None:
+            return reply
 
         # Run the assistant and get the new message
-        response = run_assistant(thread.id, name)
+        response = await run_assistant(_id, record, query, name, deadline)
 
         logger.debug("User message: ", query)
         logger.debug("AI response: ", response)
@@ -220,9 +482,67 @@ def generate_response(
         logger.info("Could not generate response. It is likely an incoming message was received while the chatbot was responding to a previous message. Details below.")
         logger.info(e)
 
-        return "Please wait while I look into your query."
+        return BUSY_MESSAGE
+
+    except TimeoutError:
+        return TIMEOUT_MESSAGE
 
     except Exception as e:
         logger.error(f"Error generating response: {e}")
 
-        return "Something went wrong processing your request, please try again later or contact a human for support."
+        return ERROR_MESSAGE
+
+
+async def stream_response(
+    query: str,
+    _id: str,
+    name: str | None = None
+):
+    """
+    Same as generate_response, but yields the response as it is generated
+    """
+    deadline = get_deadline()
+
+    with track_openai_calls() as openai_calls:
+        try:
+            async for delta in _stream_response(query, _id, name, deadline):
+                yield delta
+
+        finally:
+            logger.info(f"OpenAI calls for message: {openai_calls.total()} {dict(openai_calls)}")
+
+
+async def _stream_response(
+    query: str,
+    _id: str,
+    name: str | None,
+    deadline: float,
+):
+    # messages sent after part of the response has been streamed are separated from it
+    separator = ""
+
+    try:
+        record, reply = await prepare_thread(query, _id)
+
+        if reply is not None:
+            yield reply
+            return
+
+        async for delta in stream_assistant(_id, record, query, name, deadline):
+            separator = "\n\n"
+
+            yield delta
+
+    except BadRequestError as e:
+        logger.info("Could not stream response. It is likely an incoming message was received while the chatbot was responding to a previous message. Details below.")
+        logger.info(e)
+
+        yield separator + BUSY_MESSAGE
+
+    except TimeoutError:
+        yield separator + TIMEOUT_MESSAGE
+
+    except Exception as e:
+        logger.error(f"Error streaming response: {e}")
+
+        yield separator + ERROR_MESSAGE
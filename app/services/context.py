@@ -0,0 +1,222 @@
+"""
+This module packs scraped pages into the context sent for summarisation.
+Pages are split into passages which are ranked against the query with BM25, and only the top passages are kept,
+up to SUMMARY_TOKEN_BUDGET tokens. This leaves out navigation and other text unrelated to the query.
+"""
+import os
+
+import math
+
+from collections import Counter
+
+from functools import lru_cache
+
+from services.index import index_tokens, site_for, url_tokens
+from services.query import COLLEGES, normalise_query
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# Maximum tokens of page text sent for summarisation
+SUMMARY_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", 3000))
+
+# Pages are split into passages of about this many words, made up of whole paragraphs where possible
+PASSAGE_WORDS = int(os.getenv("PASSAGE_WORDS", 120))
+
+# Model whose tokenizer is used to count tokens
+TOKENIZER_MODEL = "gpt-4o"
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Weight of a query term found in a page's title or url, relative to its BM25 idf.
+# Added to the score of the page's matching passages, so they rank above matches on less relevant pages
+PAGE_TERM_WEIGHT = 0.5
+
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    # tiktoken is in requirements.txt, tokens are estimated if it isn't installed
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+
+    return tiktoken.encoding_for_model(TOKENIZER_MODEL)
+
+
+def count_tokens(text: str) -> int:
+    encoding = get_encoding()
+
+    if encoding is None:
+        # about four characters per token for English text
+        return len(text) // 4 + 1
+
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_passages(
+    text: str,
+    passage_words: int = PASSAGE_WORDS,
+) -> list[str]:
+    """
+    Split page text into passages of whole paragraphs, long paragraphs are split between words
+    """
+    passages = []
+    current = []
+    current_words = 0
+
+    for paragraph in text.split("\n"):
+        words = paragraph.split()
+
+        # a paragraph longer than a passage is split into several
+        for start in range(0, len(words), passage_words):
+            chunk = words[start:start + passage_words]
+
+            if current and current_words + len(chunk) > passage_words:
+                passages.append("\n".join(current))
+                current, current_words = [], 0
+
+            # runs of whitespace are collapsed, they cost tokens without adding anything
+            current.append(" ".join(chunk))
+            current_words += len(chunk)
+
+    if current:
+        passages.append("\n".join(current))
+
+    return passages
+
+
+def content_terms(terms: list[str]) -> set[str]:
+    """
+    Returns the query terms other than the college. The college is added to every search query and
+    named on every page of its site, e.g. in the footer, so it doesn't show whether a passage is relevant
+    """
+    return {term for term in terms if term not in COLLEGES} or set(terms)
+
+
+def pack_context(
+    query: str,
+    pages: list[dict], # scraped pages in rank order, with title, url and text
+    token_budget: int = SUMMARY_TOKEN_BUDGET,
+) -> list[dict]:
+    """
+    Returns the pages with their text reduced to the passages most relevant to the query, within the token budget.
+    Passages are kept in page order, and in their original order within each page.
+    """
+    terms = normalise_query(query).split()
+
+    # passages must match one of the query's terms other than the college to be selected
+    required_terms = content_terms(terms)
+
+    # (page, position, text, tokens) for every passage, scored on the passage text only
+    passages = []
+
+    # tokens of each page's title and url
+    page_tokens = []
+
+    for page_number, page in enumerate(pages):
+        page_tokens.append(set(index_tokens(page["title"] or "") + url_tokens(page["url"], site_for(page["url"]))))
+
+        for position, passage in enumerate(split_passages(page["text"])):
+            passages.append((page_number, position, passage, Counter(index_tokens(passage))))
+
+    if not passages:
+        return []
+
+    average_length = sum(sum(tokens.values()) for *_, tokens in passages) / len(passages)
+    document_frequencies = Counter(term for *_, tokens in passages for term in set(tokens) & set(terms))
+
+    def idf(term: str) -> float:
+        return math.log(1 + (len(passages) - document_frequencies[term] + 0.5) / (document_frequencies[term] + 0.5))
+
+    def score(tokens: Counter, page_number: int) -> float:
+        length = sum(tokens.values())
+        total = 0.0
+
+        for term in terms:
+            tf = tokens[term]
+
+            if tf == 0:
+                continue
+
+            total += idf(term) * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length))
+
+        # the page's title and url only boost passages that match the query themselves,
+        # so navigation and boilerplate on a matching page aren't selected
+        if required_terms & tokens.keys():
+            total += PAGE_TERM_WEIGHT * sum(idf(term) for term in set(terms) & page_tokens[page_number])
+        else:
+            total = 0.0
+
+        return total
+
+    scored = [(score(tokens, page_number), page_number, position, passage) for page_number, position, passage, tokens in passages]
+
+    # passages that don't match the query are only used if none do, then the first passages of the top pages are sent
+    if any(passage_score > 0 for passage_score, *_ in scored):
+        scored = [passage for passage in scored if passage[0] > 0]
+
+    # ties go to the higher ranked page and the earlier passage
+    scored.sort(key=lambda passage: (-passage[0], passage[1], passage[2]))
+
+    selected = []
+    used = 0
+
+    for _, page_number, position, passage in scored:
+        tokens = count_tokens(passage)
+
+        if used + tokens > token_budget:
+            continue
+
+        selected.append((page_number, position, passage))
+        used += tokens
+
+    packed = []
+
+    for page_number, page in enumerate(pages):
+        text = ""
+        previous = None
+
+        for _, position, passage in sorted(passage for passage in selected if passage[0] == page_number):
+            # gaps between passages that aren't next to each other are marked
+            if previous is not None:
+                text += "\n" if position == previous + 1 else "\n...\n"
+
+            text += passage
+            previous = position
+
+        if text:
+            packed.append({
+                "title": page["title"],
+                "url": page["url"],
+                "text": text,
+            })
+
+    return packed
+
+
+def query_coverage(
+    query: str,
+    pages: list[dict], # packed pages
+) -> float:
+    """
+    Returns the largest fraction of the query's terms, other than the college, found in the passages of any one page.
+    Only the passage text is counted, as the title and url of a page matching the query don't mean its passages answer it.
+    Used as a measure of how well the passages answer the query
+    """
+    terms = content_terms(normalise_query(query).split())
+
+    if not terms or not pages:
+        return 0.0
+
+    return max(len(terms & set(index_tokens(page["text"]))) for page in pages) / len(terms)
+
+
+def format_passages(pages: list[dict]) -> str:
+    """
+    Format packed pages as the search tool's output, with the source of each
+    """
+    return "\n\n".join(f"From {page['title']} ({page['url']}):\n{page['text']}" for page in pages)
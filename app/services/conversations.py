@@ -0,0 +1,438 @@
+"""
+This module keeps the Whatsapp messages waiting to be answered for each user, so messages sent in quick succession are
+answered together by one request rather than each starting its own run on the user's thread.
+
+A request that receives a message adds it to the user's pending messages and tries to claim the conversation.
+The request holding the claim answers pending messages until there are none left, other requests just add their message.
+Claims are leases, so a conversation whose request has died can be claimed again once its lease has passed.
+When deployed the conversations are kept in the DynamoDB table created in template.yaml for message ids, so
+messages delivered to different Lambda containers are answered together. See services/idempotency.py.
+"""
+import os
+
+import json
+
+import time
+
+import asyncio
+
+import threading
+
+from abc import ABC, abstractmethod
+
+from contextlib import contextmanager
+
+from dataclasses import dataclass, field
+
+from services.idempotency import MESSAGE_ID_STORE, MESSAGES_TABLE_NAME
+from services.storage import PATH, connect_sqlite, get_dynamodb_client
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# Where conversations are kept, one of "sqlite", "dynamodb" or "memory" (each process only).
+# Defaults to the store used for message ids
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", MESSAGE_ID_STORE)
+
+# How long a claim on a conversation lasts without being renewed. Should be longer than a response takes,
+# e.g. the 120 second Lambda timeout in template.yaml
+CONVERSATION_LEASE_SECONDS = float(os.getenv("CONVERSATION_LEASE", 120))
+
+# Conversations in DynamoDB are removed by the table's TTL once they have been idle for this long
+CONVERSATION_TTL_SECONDS = 24 * 60 * 60
+
+
+@dataclass
+class PendingMessages:
+    """
+    Messages from a user waiting to be answered
+    """
+    messages: list[str] = field(default_factory=list)
+    # wall clock times, shared between machines
+    first_received_at: float | None = None
+    last_received_at: float | None = None
+
+
+class ConversationStore(ABC):
+    """
+    Interface for conversation stores
+    """
+    @abstractmethod
+    def add(self, wa_id: str, message: str, owner: str) -> bool:
+        """
+        Add a message to the user's pending messages and try to claim the conversation for owner.
+        Returns True if owner now holds the claim and should answer the messages
+        """
+        ...
+
+    @abstractmethod
+    def pending(self, wa_id: str) -> PendingMessages:
+        ...
+
+    @abstractmethod
+    def take(self, wa_id: str, owner: str) -> list[str] | None:
+        """
+        Remove and return the pending messages, renewing owner's claim. Returns None if owner no longer holds the claim
+        """
+        ...
+
+    @abstractmethod
+    def release(self, wa_id: str, owner: str, force: bool = False) -> bool:
+        """
+        Give up owner's claim if there are no pending messages, or regardless if force is set.
+        Returns False if messages were added since they were last taken, which the owner should answer
+        """
+        ...
+
+
+@dataclass
+class _Conversation:
+    pending: PendingMessages = field(default_factory=PendingMessages)
+    owner: str | None = None
+    lease_expires_at: float = 0.0
+
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    Conversations held in process memory, messages sent to other processes are answered separately
+    """
+    def __init__(self, lease: float = CONVERSATION_LEASE_SECONDS):
+        self.lease = lease
+
+        self._conversations: dict[str, _Conversation] = {}
+        self._lock = threading.Lock()
+
+    def add(self, wa_id: str, message: str, owner: str) -> bool:
+        now = time.time()
+
+        with self._lock:
+            conversation = self._conversations.setdefault(wa_id, _Conversation())
+            pending = conversation.pending
+
+            pending.messages.append(message)
+            pending.first_received_at = pending.first_received_at or now
+            pending.last_received_at = now
+
+            if conversation.owner is not None and conversation.lease_expires_at > now:
+                return False
+
+            conversation.owner = owner
+            conversation.lease_expires_at = now + self.lease
+
+            return True
+
+    def pending(self, wa_id: str) -> PendingMessages:
+        with self._lock:
+            conversation = self._conversations.get(wa_id)
+
+            if conversation is None:
+                return PendingMessages()
+
+            pending = conversation.pending
+
+            return PendingMessages(list(pending.messages), pending.first_received_at, pending.last_received_at)
+
+    def take(self, wa_id: str, owner: str) -> list[str] | None:
+        with self._lock:
+            conversation = self._conversations.get(wa_id)
+
+            if conversation is None or conversation.owner != owner:
+                return None
+
+            messages = conversation.pending.messages
+
+            conversation.pending = PendingMessages()
+            conversation.lease_expires_at = time.time() + self.lease
+
+            return messages
+
+    def release(self, wa_id: str, owner: str, force: bool = False) -> bool:
+        with self._lock:
+            conversation = self._conversations.get(wa_id)
+
+            if conversation is None or conversation.owner != owner:
+                return True
+
+            if conversation.pending.messages and not force:
+                return False
+
+            if conversation.pending.messages:
+                conversation.owner = None
+            else:
+                del self._conversations[wa_id]
+
+            return True
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Conversations shared by worker processes on the same machine
+    """
+    def __init__(
+        self,
+        path: str = PATH,
+        lease: float = CONVERSATION_LEASE_SECONDS,
+    ):
+        self.lease = lease
+
+        self._conn = connect_sqlite(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                messages TEXT NOT NULL,
+                first_received_at REAL,
+                last_received_at REAL,
+                owner TEXT,
+                lease_expires_at REAL NOT NULL
+            )
+        """)
+
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            # the write lock is taken up front so other processes can't change the conversation in between
+            self._conn.execute("BEGIN IMMEDIATE")
+
+            try:
+                yield
+
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+            self._conn.execute("COMMIT")
+
+    def _select(self, wa_id: str) -> tuple | None:
+        return self._conn.execute(
+            "SELECT messages, first_received_at, last_received_at, owner, lease_expires_at FROM conversations WHERE id = ?", (wa_id,)
+        ).fetchone()
+
+    def add(self, wa_id: str, message: str, owner: str) -> bool:
+        now = time.time()
+
+        with self._transaction():
+            row = self._select(wa_id)
+
+            messages, first_received_at, _, current_owner, lease_expires_at = row or ("[]", None, None, None, 0.0)
+
+            claimed = current_owner is None or lease_expires_at <= now
+
+            if claimed:
+                current_owner, lease_expires_at = owner, now + self.lease
+
+            self._conn.execute(
+                "INSERT OR REPLACE INTO conversations VALUES (?, ?, ?, ?, ?, ?)",
+                (wa_id, json.dumps([*json.loads(messages), message]), first_received_at or now, now, current_owner, lease_expires_at),
+            )
+
+        return claimed
+
+    def pending(self, wa_id: str) -> PendingMessages:
+        with self._lock:
+            row = self._select(wa_id)
+
+        if row is None:
+            return PendingMessages()
+
+        return PendingMessages(json.loads(row[0]), row[1], row[2])
+
+    def take(self, wa_id: str, owner: str) -> list[str] | None:
+        with self._transaction():
+            row = self._select(wa_id)
+
+            if row is None or row[3] != owner:
+                return None
+
+            self._conn.execute(
+                "UPDATE conversations SET messages = '[]', first_received_at = NULL, last_received_at = NULL, lease_expires_at = ? WHERE id = ?",
+                (time.time() + self.lease, wa_id),
+            )
+
+        return json.loads(row[0])
+
+    def release(self, wa_id: str, owner: str, force: bool = False) -> bool:
+        with self._lock:
+            if force:
+                self._conn.execute("UPDATE conversations SET owner = NULL WHERE id = ? AND owner = ?", (wa_id, owner))
+                return True
+
+            self._conn.execute("DELETE FROM conversations WHERE id = ? AND owner = ? AND messages = '[]'", (wa_id, owner))
+
+            row = self._select(wa_id)
+
+        return row is None or row[3] != owner
+
+
+class DynamoDBConversationStore(ConversationStore):
+    """
+    Conversations shared by every container, kept in the message id table under a "conversation#" prefix
+    """
+    def __init__(
+        self,
+        table_name: str = MESSAGES_TABLE_NAME,
+        lease: float = CONVERSATION_LEASE_SECONDS,
+        client = None,
+    ):
+        if not table_name:
+            raise ValueError("MESSAGES_TABLE_NAME must be set to use the DynamoDB conversation store")
+
+        self.lease = lease
+
+        self._table_name = table_name
+        self._client = client or get_dynamodb_client()
+
+    @staticmethod
+    def _key(wa_id: str) -> dict:
+        return {"id": {"S": f"conversation#{wa_id}"}}
+
+    def _update(self, wa_id: str, expression: str, values: dict, condition: str | None = None, return_values: str = "NONE"):
+        kwargs = {}
+
+        if condition is not None:
+            kwargs["ConditionExpression"] = condition
+
+        # "owner" is a reserved word, DynamoDB rejects attribute names that aren't used so it is only passed when needed
+        if "#owner" in expression + (condition or ""):
+            kwargs["ExpressionAttributeNames"] = {"#owner": "owner"}
+
+        return self._client.update_item(
+            TableName=self._table_name,
+            Key=self._key(wa_id),
+            UpdateExpression=expression,
+            ExpressionAttributeValues=values,
+            ReturnValues=return_values,
+            **kwargs,
+        )
+
+    def add(self, wa_id: str, message: str, owner: str) -> bool:
+        now = time.time()
+
+        self._update(
+            wa_id,
+            "SET pending_messages = list_append(if_not_exists(pending_messages, :empty), :message), "
+            "first_received_at = if_not_exists(first_received_at, :now), last_received_at = :now, expires_at = :expires_at",
+            {
+                ":empty": {"L": []},
+                ":message": {"L": [{"S": message}]},
+                ":now": {"N": str(now)},
+                ":expires_at": {"N": str(int(now + CONVERSATION_TTL_SECONDS))},
+            },
+        )
+
+        # the message is added before claiming, so an owner releasing in between sees it and keeps answering
+        try:
+            self._update(
+                wa_id,
+                "SET #owner = :owner, lease_expires_at = :lease_expires_at",
+                {
+                    ":owner": {"S": owner},
+                    ":lease_expires_at": {"N": str(now + self.lease)},
+                    ":now": {"N": str(now)},
+                },
+                condition="attribute_not_exists(#owner) OR lease_expires_at <= :now",
+            )
+
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+    def pending(self, wa_id: str) -> PendingMessages:
+        item = self._client.get_item(
+            TableName=self._table_name,
+            Key=self._key(wa_id),
+            ConsistentRead=True,
+        ).get("Item", {})
+
+        return PendingMessages(
+            [message["S"] for message in item.get("pending_messages", {}).get("L", [])],
+            float(item["first_received_at"]["N"]) if "first_received_at" in item else None,
+            float(item["last_received_at"]["N"]) if "last_received_at" in item else None,
+        )
+
+    def take(self, wa_id: str, owner: str) -> list[str] | None:
+        try:
+            response = self._update(
+                wa_id,
+                "SET pending_messages = :empty, lease_expires_at = :lease_expires_at REMOVE first_received_at, last_received_at",
+                {
+                    ":empty": {"L": []},
+                    ":owner": {"S": owner},
+                    ":lease_expires_at": {"N": str(time.time() + self.lease)},
+                },
+                condition="#owner = :owner",
+                return_values="ALL_OLD",
+            )
+
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return None
+
+        return [message["S"] for message in response["Attributes"].get("pending_messages", {}).get("L", [])]
+
+    def release(self, wa_id: str, owner: str, force: bool = False) -> bool:
+        values = {":owner": {"S": owner}}
+        condition = "#owner = :owner"
+
+        if not force:
+            values[":zero"] = {"N": "0"}
+            condition += " AND size(pending_messages) = :zero"
+
+        try:
+            self._update(wa_id, "REMOVE #owner, lease_expires_at", values, condition=condition)
+
+        except self._client.exceptions.ConditionalCheckFailedException:
+            # either messages are waiting, or the claim has already passed to another request which will answer them
+            return force or not self._holds_claim(wa_id, owner)
+
+        return True
+
+    def _holds_claim(self, wa_id: str, owner: str) -> bool:
+        item = self._client.get_item(
+            TableName=self._table_name,
+            Key=self._key(wa_id),
+            ConsistentRead=True,
+        ).get("Item", {})
+
+        return item.get("owner", {}).get("S") == owner
+
+
+_store: ConversationStore | None = None
+_store_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    """
+    Returns the store configured by CONVERSATION_STORE
+    """
+    global _store
+
+    with _store_lock:
+        if _store is None:
+            match CONVERSATION_STORE:
+                case "dynamodb":
+                    _store = DynamoDBConversationStore(MESSAGES_TABLE_NAME)
+
+                case "sqlite":
+                    _store = SQLiteConversationStore(PATH)
+
+                case "memory":
+                    _store = InMemoryConversationStore()
+
+                case _:
+                    raise ValueError(f"Unknown conversation store '{CONVERSATION_STORE}'")
+
+        return _store
+
+
+async def run_in_store(method, *args):
+    """
+    Call a store method from the event loop. The shared stores (sqlite3, boto3) are blocking so they run in a worker thread
+    """
+    if CONVERSATION_STORE == "memory":
+        return method(*args)
+
+    return await asyncio.to_thread(method, *args)
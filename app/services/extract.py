@@ -0,0 +1,213 @@
+"""
+This module extracts text content from html pages.
+Script, style, link, header, footer and nav elements are removed and the remaining text is returned one paragraph per line.
+The extractor is chosen with HTML_EXTRACTOR, see scripts/benchmark_extract.py to compare them.
+"""
+import os
+
+from abc import ABC, abstractmethod
+
+from functools import lru_cache
+
+from html.parser import HTMLParser
+
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# One of "soup", "streaming" or "lxml". Defaults to "lxml" if it is installed and "streaming" otherwise
+HTML_EXTRACTOR = os.getenv("HTML_EXTRACTOR") or None
+
+REMOVED_TAGS = {"script", "style", "a", "header", "footer", "nav"}
+
+# Whitespace is kept as is inside these elements
+PREFORMATTED_TAGS = {"pre", "textarea"}
+
+ASCII_SPACES = " \t\n\r\f"
+
+
+def join_paragraphs(text: str) -> str:
+    # remove unnecessary line breaks and return as string
+    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
+
+    return "\n".join(paragraphs)
+
+
+def clean_soup(soup: BeautifulSoup):
+    # remove all script, style, header and fotter elements
+    for script in soup(["script", "style", "a", "header", "footer", "nav"]):
+        script.extract()
+
+    # extract text
+    text = soup.get_text()
+
+    return join_paragraphs(text)
+
+
+class Extractor(ABC):
+    name: str
+
+    @abstractmethod
+    def extract_page(self, html: str, url: str = "") -> tuple[str, str, list[str]]:
+        """
+        Returns the title, text content and links of a page, with links resolved against url
+        """
+        pass
+
+    def extract(self, html: str) -> str:
+        """
+        Returns the text content of a page
+        """
+        return self.extract_page(html)[1]
+
+
+class SoupExtractor(Extractor):
+    """
+    Builds the full BeautifulSoup tree then removes unwanted elements from it
+    """
+    name = "soup"
+
+    def extract_page(self, html: str, url: str = "") -> tuple[str, str, list[str]]:
+        soup = BeautifulSoup(html, "html.parser")
+
+        title = soup.title.get_text(strip=True) if soup.title else ""
+
+        # links are collected before clean_soup() removes them
+        links = [urljoin(url, a["href"]) for a in soup.find_all("a", href=True)]
+
+        return title, clean_soup(soup), links
+
+
+class TextCollector:
+    """
+    Parser target that keeps text as it is parsed, dropping the text of removed elements and everything inside them.
+    No tree is built so each element is only visited once.
+    """
+    def __init__(self, url: str = ""):
+        self.url = url
+
+        self._text = []
+        self._title = []
+        self._links = []
+        self._in_title = False
+        # removed and preformatted elements that are currently open
+        self._removed = []
+        self._preformatted = 0
+
+    def start(self, tag: str, attrs: dict):
+        if tag == "a" and attrs.get("href"):
+            self._links.append(urljoin(self.url, attrs["href"]))
+
+        if tag in REMOVED_TAGS:
+            self._removed.append(tag)
+        elif tag == "title":
+            self._in_title = True
+        elif tag in PREFORMATTED_TAGS:
+            self._preformatted += 1
+
+    def end(self, tag: str):
+        if tag in self._removed:
+            # also close removed elements left open inside this one
+            while self._removed.pop() != tag:
+                pass
+        elif tag == "title":
+            self._in_title = False
+        elif tag in PREFORMATTED_TAGS and self._preformatted:
+            self._preformatted -= 1
+
+    def data(self, data: str):
+        if self._in_title:
+            self._title.append(data)
+
+        if self._removed:
+            return
+
+        # whitespace between elements is collapsed as BeautifulSoup does, so paragraphs are split the same way
+        if not self._preformatted and not data.strip(ASCII_SPACES):
+            data = "\n" if "\n" in data else " "
+
+        self._text.append(data)
+
+    def close(self) -> tuple[str, str, list[str]]:
+        return "".join(self._title).strip(), join_paragraphs("".join(self._text)), self._links
+
+
+class _StreamingParser(HTMLParser):
+    def __init__(self, target: TextCollector):
+        super().__init__(convert_charrefs=True)
+
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+
+class StreamingExtractor(Extractor):
+    """
+    Extracts text while parsing with the standard library's HTMLParser
+    """
+    name = "streaming"
+
+    def extract_page(self, html: str, url: str = "") -> tuple[str, str, list[str]]:
+        target = TextCollector(url)
+
+        parser = _StreamingParser(target)
+        parser.feed(html)
+        parser.close()
+
+        return target.close()
+
+
+class LxmlExtractor(Extractor):
+    """
+    Extracts text while parsing with lxml's C parser, which calls the collector directly instead of building a tree
+    """
+    name = "lxml"
+
+    def __init__(self):
+        # lxml is optional, see requirements.txt
+        from lxml import etree
+
+        self._etree = etree
+
+    def extract_page(self, html: str, url: str = "") -> tuple[str, str, list[str]]:
+        parser = self._etree.HTMLParser(target=TextCollector(url), encoding="utf-8")
+        parser.feed(html.encode("utf-8"))
+
+        return parser.close()
+
+
+EXTRACTORS = {
+    extractor.name: extractor
+    for extractor in (SoupExtractor, StreamingExtractor, LxmlExtractor)
+}
+
+
+@lru_cache(maxsize=None)
+def get_extractor(name: str | None = HTML_EXTRACTOR) -> Extractor:
+    if name is not None:
+        return EXTRACTORS[name]()
+
+    try:
+        return LxmlExtractor()
+    except ImportError:
+        return StreamingExtractor()
+
+
+def parse(html: str):
+    return get_extractor().extract(html)
+
+
+def extract_page(html: str, url: str = "") -> tuple[str, str, list[str]]:
+    return get_extractor().extract_page(html, url)
@@ -0,0 +1,172 @@
+"""
+This module provides the Google Custom Search client, used when a search isn't served by the local index.
+The service is built once from the discovery document bundled with the client library. httplib2 isn't thread safe,
+so each worker thread keeps its own connection which is reused between searches.
+Searches made at about the same time, e.g. when the assistant asks for several searches at once, are sent in one batch request.
+"""
+import os
+
+import asyncio
+
+import threading
+
+from functools import lru_cache
+
+import httplib2
+
+from googleapiclient.discovery import build
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Define constants
+GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")
+
+GOOGLE_SEARCH_TIMEOUT_SECONDS = float(os.getenv("GOOGLE_SEARCH_TIMEOUT", 10))
+
+# Searches made within SEARCH_BATCH_WINDOW seconds of each other are sent together. Set to 0 to disable batching
+SEARCH_BATCH_WINDOW_SECONDS = float(os.getenv("SEARCH_BATCH_WINDOW", 0.01))
+SEARCH_BATCH_MAX_SIZE = int(os.getenv("SEARCH_BATCH_MAX_SIZE", 10))
+
+
+class GoogleSearchClient:
+    """
+    Thread safe Custom Search client, see docs below
+    https://google-api-client-libraries.appspot.com/documentation/customsearch/v1/python/latest/customsearch_v1.cse.html
+    """
+    def __init__(
+        self,
+        api_key: str | None = GOOGLE_API_KEY,
+        cse_id: str | None = GOOGLE_CSE_ID,
+    ):
+        # static_discovery uses the discovery document shipped with the library instead of fetching it
+        self._service = build("customsearch", "v1", developerKey=api_key, static_discovery=True, cache_discovery=False)
+        self._cse = self._service.cse()
+        self._cse_id = cse_id
+
+        self._local = threading.local()
+
+    def _http(self) -> httplib2.Http:
+        http = getattr(self._local, "http", None)
+
+        if http is None:
+            http = self._local.http = httplib2.Http(timeout=GOOGLE_SEARCH_TIMEOUT_SECONDS)
+
+        return http
+
+    def _request(self, query: str, site: str | None, num: int):
+        return self._cse.list(q=query, num=num, siteSearch=site, cx=self._cse_id)
+
+    def search(
+        self,
+        query: str,
+        site: str | None = None, # limit results to specific site
+        num: int = 3, # number search results to return
+    ) -> list[dict]:
+        result = self._request(query, site, num).execute(http=self._http(), num_retries=1)
+
+        return result.get("items", [])[:num]
+
+    def search_many(
+        self,
+        searches: list[tuple[str, str | None, int]], # (query, site, num) for each search
+    ) -> list[list[dict] | Exception]:
+        """
+        Run several searches in one batch request. Returns the results of each search, or the exception it raised
+        """
+        results: list[list[dict] | Exception | None] = [None] * len(searches)
+
+        def callback(request_id, response, exception):
+            i = int(request_id)
+
+            results[i] = exception if exception is not None else response.get("items", [])[:searches[i][2]]
+
+        batch = self._service.new_batch_http_request(callback=callback)
+
+        for i, search in enumerate(searches):
+            batch.add(self._request(*search), request_id=str(i))
+
+        batch.execute(http=self._http())
+
+        return results
+
+
+class SearchBatcher:
+    """
+    Collects searches made within window seconds of each other and sends them to Google in one batch request
+    """
+    def __init__(
+        self,
+        client: GoogleSearchClient,
+        window: float = SEARCH_BATCH_WINDOW_SECONDS,
+        max_size: int = SEARCH_BATCH_MAX_SIZE,
+    ):
+        self.client = client
+        self.window = window
+        self.max_size = max_size
+
+        self._pending: list[tuple[tuple, asyncio.Future]] = []
+        self._flush_handle: asyncio.TimerHandle | None = None
+        # keeps a reference to running batches so they aren't garbage collected
+        self._tasks: set[asyncio.Task] = set()
+
+    async def search(
+        self,
+        query: str,
+        site: str | None = None,
+        num: int = 3,
+    ) -> list[dict]:
+        # the Google API client is blocking, run it in a worker thread
+        if self.window <= 0:
+            return await asyncio.to_thread(self.client.search, query, site, num)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        self._pending.append(((query, site, num), future))
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+
+        task = asyncio.create_task(self._send(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, pending: list[tuple[tuple, asyncio.Future]]):
+        searches = [search for search, _ in pending]
+
+        try:
+            if len(searches) == 1:
+                results = [await asyncio.to_thread(self.client.search, *searches[0])]
+            else:
+                results = await asyncio.to_thread(self.client.search_many, searches)
+        except Exception as e:
+            results = [e] * len(pending)
+
+        for (_, future), result in zip(pending, results):
+            # the search may have been cancelled while waiting
+            if future.done():
+                continue
+
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+@lru_cache(maxsize=1)
+def get_search_batcher() -> SearchBatcher:
+    return SearchBatcher(GoogleSearchClient())
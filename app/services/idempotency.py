@@ -0,0 +1,223 @@
+"""
+This module records the ids of WhatsApp messages that have been received, so a message Whatsapp delivers more than once is only answered once.
+
+Each process keeps the most recent ids in memory, bounded in size and age, so most duplicates are rejected without a request.
+Ids can also be claimed in a shared store, so duplicates delivered to another worker or Lambda container are caught.
+When deployed this is the DynamoDB table created in template.yaml, where each id is claimed with a conditional write.
+"""
+import os
+
+import time
+
+import asyncio
+
+import logging
+
+import threading
+
+from abc import ABC, abstractmethod
+
+from collections import OrderedDict
+
+from services.storage import PATH, connect_sqlite, get_dynamodb_client
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+logger = logging.getLogger(__name__)
+
+# How long message ids are remembered. Whatsapp retries undelivered webhooks for up to 7 days
+MESSAGE_ID_TTL_SECONDS = float(os.getenv("MESSAGE_ID_TTL", 7 * 24 * 60 * 60))
+
+# Maximum number of message ids kept in memory by each process
+MESSAGE_ID_CACHE_SIZE = int(os.getenv("MESSAGE_ID_CACHE_SIZE", 10_000))
+
+# Shared store for message ids, one of "sqlite", "dynamodb" or "memory" (no shared store)
+# Defaults to DynamoDB when the MESSAGES_TABLE_NAME from template.yaml is present
+MESSAGES_TABLE_NAME = os.getenv("MESSAGES_TABLE_NAME")
+MESSAGE_ID_STORE = os.getenv("MESSAGE_ID_STORE", "dynamodb" if MESSAGES_TABLE_NAME else "memory")
+
+# Expired ids are removed from the SQLite store once every this many claims
+SQLITE_PURGE_INTERVAL = 1000
+
+
+class MessageIdStore(ABC):
+    """
+    Interface for message id stores
+    """
+    @abstractmethod
+    def claim(self, message_id: str) -> bool:
+        """
+        Record a message id. Returns False if it has already been recorded
+        """
+        ...
+
+
+class InMemoryMessageIdStore(MessageIdStore):
+    """
+    Message ids in insertion order, which is also expiry order. Expired and excess ids are removed from the front on each claim
+    """
+    def __init__(
+        self,
+        ttl: float = MESSAGE_ID_TTL_SECONDS,
+        max_size: int = MESSAGE_ID_CACHE_SIZE,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+
+        self._expires_at: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, message_id: str) -> bool:
+        now = time.monotonic()
+
+        with self._lock:
+            while self._expires_at and next(iter(self._expires_at.values())) <= now:
+                self._expires_at.popitem(last=False)
+
+            if message_id in self._expires_at:
+                return False
+
+            if len(self._expires_at) >= self.max_size:
+                self._expires_at.popitem(last=False)
+
+            self._expires_at[message_id] = now + self.ttl
+
+        return True
+
+
+class SQLiteMessageIdStore(MessageIdStore):
+    """
+    Message ids shared by worker processes on the same machine
+    """
+    def __init__(
+        self,
+        path: str = PATH,
+        ttl: float = MESSAGE_ID_TTL_SECONDS,
+    ):
+        self.ttl = ttl
+
+        self._conn = connect_sqlite(path)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS message_ids (id TEXT PRIMARY KEY, expires_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS message_ids_expires_at ON message_ids (expires_at)")
+
+        self._lock = threading.Lock()
+        self._claims = 0
+
+    def claim(self, message_id: str) -> bool:
+        now = time.time()
+
+        with self._lock:
+            # an expired id is claimed again in place
+            cursor = self._conn.execute(
+                """
+                INSERT INTO message_ids (id, expires_at) VALUES (?, ?)
+                ON CONFLICT (id) DO UPDATE SET expires_at = excluded.expires_at WHERE message_ids.expires_at <= ?
+                """,
+                (message_id, now + self.ttl, now),
+            )
+
+            self._claims += 1
+
+            if self._claims % SQLITE_PURGE_INTERVAL == 0:
+                self._conn.execute("DELETE FROM message_ids WHERE expires_at <= ?", (now,))
+
+            return cursor.rowcount == 1
+
+
+class DynamoDBMessageIdStore(MessageIdStore):
+    """
+    Message ids shared by every container. Expired ids are removed by the table's native TTL on 'expires_at'
+    """
+    def __init__(
+        self,
+        table_name: str = MESSAGES_TABLE_NAME,
+        ttl: float = MESSAGE_ID_TTL_SECONDS,
+        client = None,
+    ):
+        if not table_name:
+            raise ValueError("MESSAGES_TABLE_NAME must be set to use the DynamoDB message id store")
+
+        self.ttl = ttl
+
+        self._table_name = table_name
+        self._client = client or get_dynamodb_client()
+
+    def claim(self, message_id: str) -> bool:
+        now = int(time.time())
+
+        try:
+            # DynamoDB removes expired items some time after they expire, so expired items that remain can be claimed again
+            self._client.put_item(
+                TableName=self._table_name,
+                Item={
+                    "id": {"S": message_id},
+                    "expires_at": {"N": str(now + int(self.ttl))},
+                },
+                ConditionExpression="attribute_not_exists(id) OR expires_at <= :now",
+                ExpressionAttributeValues={":now": {"N": str(now)}},
+            )
+
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return False
+
+        return True
+
+
+_recent_message_ids = InMemoryMessageIdStore()
+
+_shared_store: MessageIdStore | None = None
+_shared_store_lock = threading.Lock()
+
+
+def get_shared_store() -> MessageIdStore | None:
+    """
+    Returns the shared store configured by MESSAGE_ID_STORE, or None if ids are only kept in memory
+    """
+    global _shared_store
+
+    with _shared_store_lock:
+        if _shared_store is None:
+            match MESSAGE_ID_STORE:
+                case "dynamodb":
+                    _shared_store = DynamoDBMessageIdStore(MESSAGES_TABLE_NAME)
+
+                case "sqlite":
+                    _shared_store = SQLiteMessageIdStore(PATH)
+
+                case "memory":
+                    return None
+
+                case _:
+                    raise ValueError(f"Unknown message id store '{MESSAGE_ID_STORE}'")
+
+        return _shared_store
+
+
+def claim_message(message_id: str) -> bool:
+    """
+    Returns True the first time a message id is seen, and False for duplicates
+    """
+    if not _recent_message_ids.claim(message_id):
+        return False
+
+    try:
+        shared_store = get_shared_store()
+
+        return shared_store is None or shared_store.claim(message_id)
+
+    except Exception as e:
+        # answering a message twice is better than not answering it
+        logger.warning(f"Error claiming message id, processing message anyway: {e!r}")
+
+        return True
+
+
+async def claim_message_async(message_id: str) -> bool:
+    # the first check is in memory, the shared stores (sqlite3, boto3) are blocking so they run in a worker thread
+    if MESSAGE_ID_STORE == "memory":
+        return claim_message(message_id)
+
+    return await asyncio.to_thread(claim_message, message_id)
@@ -0,0 +1,542 @@
+"""
+This module crawls the partner colleges' websites into a local search index, so searches don't need to call Google.
+Pages are stored in an inverted index in SQLite and ranked with BM25F, which weights matches in the title and url above the body.
+The index is opened read only and memory mapped, so worker processes share the OS page cache rather than each loading a copy.
+Build or refresh the index with scripts/build_index.py.
+"""
+import os
+
+import logging
+
+import json
+
+import math
+
+import time
+
+import asyncio
+
+import hashlib
+
+import sqlite3
+
+import threading
+
+from collections import Counter, defaultdict
+
+from urllib.parse import urldefrag, urlsplit
+from urllib.robotparser import RobotFileParser
+
+import httpx
+
+from services.extract import extract_page
+from services.query import COLLEGE_NAMES, STOP_WORDS, fold_aliases, normalise_query, tokenize
+from services.storage import DIRECTORY, connect_sqlite
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+INDEX_PATH = os.getenv("KNOWLEDGE_INDEX_PATH", f"{DIRECTORY}/knowledge_index.db")
+
+# Sites that are crawled, and the college each belongs to. The college key is indexed with each page's url
+# so that e.g. "collins" matches pages on collinsacademy.edu.au
+SITES = {
+    "lauruseducation.com.au": None,
+    "allied.edu.au": "allied",
+    "hilton.edu.au": "hilton",
+    "collinsacademy.edu.au": "collins",
+    "paragon.edu.au": "paragon",
+    "ecoc.edu.au": "everthought",
+    "everthought.edu.au": "everthought",
+    "future.edu.au": "future",
+}
+
+CRAWL_MAX_PAGES_PER_SITE = int(os.getenv("CRAWL_MAX_PAGES_PER_SITE", 500))
+CRAWL_CONCURRENCY_PER_SITE = int(os.getenv("CRAWL_CONCURRENCY_PER_SITE", 4))
+CRAWL_TIMEOUT_SECONDS = float(os.getenv("CRAWL_TIMEOUT", 15))
+CRAWL_USER_AGENT = os.getenv("CRAWL_USER_AGENT", "LaurusEducationChatBot/1.0")
+
+# Pages that haven't been reached by a crawl for this long are removed from the index
+CRAWL_MAX_AGE_SECONDS = float(os.getenv("CRAWL_MAX_AGE", 7 * 24 * 60 * 60))
+
+# Links to files with these extensions are not crawled
+SKIPPED_EXTENSIONS = (
+    ".pdf", ".doc", ".docx", ".xls", ".xlsx", ".ppt", ".pptx", ".zip",
+    ".jpg", ".jpeg", ".png", ".gif", ".svg", ".webp", ".mp4", ".mp3", ".css", ".js", ".xml",
+)
+
+# Bytes of the index file mapped into memory by each reader
+INDEX_MMAP_SIZE = int(os.getenv("KNOWLEDGE_INDEX_MMAP_SIZE", 256 * 1024 * 1024))
+
+# How often readers reload document lengths, to pick up a recrawl
+INDEX_REFRESH_SECONDS = float(os.getenv("KNOWLEDGE_INDEX_REFRESH", 60))
+
+# BM25F parameters, weights and length normalisation for each field
+BM25_K1 = 1.2
+FIELD_WEIGHTS = {"title": 3.0, "url": 2.0, "body": 1.0}
+FIELD_B = {"title": 0.5, "url": 0.5, "body": 0.75}
+FIELDS = tuple(FIELD_WEIGHTS)
+
+CREATE_DOCUMENTS_SQL = """
+    CREATE TABLE IF NOT EXISTS documents (
+        id INTEGER PRIMARY KEY,
+        url TEXT NOT NULL UNIQUE,
+        site TEXT NOT NULL,
+        title TEXT NOT NULL,
+        text TEXT NOT NULL,
+        links TEXT NOT NULL,
+        title_length INTEGER NOT NULL,
+        url_length INTEGER NOT NULL,
+        body_length INTEGER NOT NULL,
+        content_hash TEXT NOT NULL,
+        etag TEXT,
+        last_modified TEXT,
+        crawled_at REAL NOT NULL
+    )
+"""
+
+CREATE_POSTINGS_SQL = """
+    CREATE TABLE IF NOT EXISTS postings (
+        term TEXT NOT NULL,
+        document_id INTEGER NOT NULL,
+        title_tf INTEGER NOT NULL,
+        url_tf INTEGER NOT NULL,
+        body_tf INTEGER NOT NULL,
+        PRIMARY KEY (term, document_id)
+    ) WITHOUT ROWID
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def index_tokens(text: str) -> list[str]:
+    """
+    Tokens indexed for a field, with college names folded and stop words removed as they are for queries
+    """
+    return tokenize(fold_aliases(text), STOP_WORDS)
+
+
+def url_tokens(url: str, site: str) -> list[str]:
+    parts = urlsplit(url)
+
+    tokens = index_tokens(f"{parts.netloc} {parts.path}")
+
+    # the college's name is tokenized as it is in queries, e.g. so "Future English" becomes "futureenglish"
+    if SITES.get(site) is not None:
+        tokens += index_tokens(COLLEGE_NAMES[SITES[site]])
+
+    return tokens
+
+
+def site_for(url: str) -> str | None:
+    """
+    Returns the crawled site a url belongs to, including subdomains e.g. www.
+    """
+    host = urlsplit(url).hostname or ""
+
+    for site in SITES:
+        if host == site or host.endswith(f".{site}"):
+            return site
+
+    return None
+
+
+class KnowledgeIndex:
+    """
+    Inverted index over crawled pages.
+    Readers open the database read only, the crawler opens it with read_only=False to add and update pages.
+    """
+    def __init__(
+        self,
+        path: str = INDEX_PATH,
+        read_only: bool = True,
+    ):
+        self.read_only = read_only
+
+        if read_only:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            self._conn.execute(f"PRAGMA mmap_size = {INDEX_MMAP_SIZE}")
+        else:
+            self._conn = connect_sqlite(path)
+            self._conn.execute(CREATE_DOCUMENTS_SQL)
+            self._conn.execute(CREATE_POSTINGS_SQL)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS postings_document_id ON postings (document_id)")
+
+        self._lock = threading.Lock()
+
+        # document id -> (site, title, url and body lengths), loaded by _refresh()
+        self._lengths: dict[int, tuple] = {}
+        self._average_lengths = {field: 1.0 for field in FIELDS}
+        self._loaded_at: float | None = None
+
+    def _refresh(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < INDEX_REFRESH_SECONDS:
+            return
+
+        rows = self._conn.execute("SELECT id, site, title_length, url_length, body_length FROM documents").fetchall()
+
+        self._lengths = {row[0]: row[1:] for row in rows}
+
+        for i, field in enumerate(FIELDS, start=1):
+            self._average_lengths[field] = max(sum(row[i] for row in self._lengths.values()) / len(rows), 1.0) if rows else 1.0
+
+        self._loaded_at = time.monotonic()
+
+    def search(
+        self,
+        query: str,
+        num: int = 3,
+        site: str | None = None, # limit results to pages on this site
+    ) -> list[dict]:
+        """
+        Returns the top pages for the query in the same shape as Google search results, with the page text included
+        """
+        terms = normalise_query(query).split()
+
+        scores: defaultdict[int, float] = defaultdict(float)
+
+        with self._lock:
+            self._refresh()
+
+            total = len(self._lengths)
+
+            for term in terms:
+                rows = self._conn.execute(
+                    "SELECT document_id, title_tf, url_tf, body_tf FROM postings WHERE term = ?", (term,)
+                ).fetchall()
+
+                if not rows:
+                    continue
+
+                idf = math.log(1 + (total - len(rows) + 0.5) / (len(rows) + 0.5))
+
+                for document_id, *frequencies in rows:
+                    # skip pages added since the lengths were loaded
+                    if document_id not in self._lengths:
+                        continue
+
+                    document_site, *lengths = self._lengths[document_id]
+
+                    if site is not None and document_site != site:
+                        continue
+
+                    tf = sum(
+                        FIELD_WEIGHTS[field] * frequency / (1 - FIELD_B[field] + FIELD_B[field] * length / self._average_lengths[field])
+                        for field, frequency, length in zip(FIELDS, frequencies, lengths)
+                    )
+
+                    scores[document_id] += idf * tf / (BM25_K1 + tf)
+
+            top = sorted(scores, key=scores.get, reverse=True)[:num]
+
+            if not top:
+                return []
+
+            rows = self._conn.execute(
+                f"SELECT id, url, title, text FROM documents WHERE id IN ({', '.join('?' for _ in top)})", top
+            ).fetchall()
+
+        documents = {row[0]: row[1:] for row in rows}
+
+        return [
+            {
+                "title": documents[document_id][1],
+                "link": documents[document_id][0],
+                "text": documents[document_id][2],
+            } for document_id in top if document_id in documents
+        ]
+
+    def validators(self) -> dict[str, tuple[str | None, str | None]]:
+        """
+        Returns the ETag and Last-Modified of each indexed page, used for conditional requests when recrawling
+        """
+        with self._lock:
+            return {url: (etag, last_modified) for url, etag, last_modified in self._conn.execute("SELECT url, etag, last_modified FROM documents")}
+
+    def links(self, url: str) -> list[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT links FROM documents WHERE url = ?", (url,)).fetchone()
+
+        return json.loads(row[0]) if row is not None else []
+
+    def touch(self, url: str):
+        """
+        Mark a page as unchanged by a crawl
+        """
+        with self._lock:
+            self._conn.execute("UPDATE documents SET crawled_at = ? WHERE url = ?", (time.time(), url))
+
+    def upsert(
+        self,
+        url: str,
+        site: str,
+        title: str,
+        text: str,
+        links: list[str],
+        etag: str | None = None,
+        last_modified: str | None = None,
+    ) -> bool:
+        """
+        Add or update a page. Postings are only rewritten if the content has changed. Returns whether it changed
+        """
+        content_hash = hashlib.sha256(f"{title}\n{text}".encode()).hexdigest()
+
+        fields = {
+            "title": Counter(index_tokens(title)),
+            "url": Counter(url_tokens(url, site)),
+            "body": Counter(index_tokens(text)),
+        }
+
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT id, content_hash FROM documents WHERE url = ?", (url,)).fetchone()
+
+            if row is not None and row[1] == content_hash:
+                self._conn.execute(
+                    "UPDATE documents SET links = ?, etag = ?, last_modified = ?, crawled_at = ? WHERE id = ?",
+                    (json.dumps(links), etag, last_modified, time.time(), row[0]),
+                )
+                return False
+
+            values = (
+                site, title, text, json.dumps(links),
+                sum(fields["title"].values()), sum(fields["url"].values()), sum(fields["body"].values()),
+                content_hash, etag, last_modified, time.time(),
+            )
+
+            if row is None:
+                document_id = self._conn.execute(
+                    """
+                    INSERT INTO documents (site, title, text, links, title_length, url_length, body_length, content_hash, etag, last_modified, crawled_at, url)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (*values, url),
+                ).lastrowid
+            else:
+                document_id = row[0]
+
+                self._conn.execute(
+                    """
+                    UPDATE documents SET site = ?, title = ?, text = ?, links = ?, title_length = ?, url_length = ?, body_length = ?,
+                    content_hash = ?, etag = ?, last_modified = ?, crawled_at = ? WHERE id = ?
+                    """,
+                    (*values, document_id),
+                )
+                self._conn.execute("DELETE FROM postings WHERE document_id = ?", (document_id,))
+
+            terms = set().union(*fields.values())
+
+            self._conn.executemany(
+                "INSERT INTO postings (term, document_id, title_tf, url_tf, body_tf) VALUES (?, ?, ?, ?, ?)",
+                [(term, document_id, *(fields[field][term] for field in FIELDS)) for term in terms],
+            )
+
+        return True
+
+    def remove(self, url: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM postings WHERE document_id IN (SELECT id FROM documents WHERE url = ?)", (url,))
+            self._conn.execute("DELETE FROM documents WHERE url = ?", (url,))
+
+    def remove_older_than(self, crawled_before: float) -> int:
+        """
+        Remove pages that haven't been reached by a crawl since crawled_before. Returns the number removed
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM postings WHERE document_id IN (SELECT id FROM documents WHERE crawled_at < ?)", (crawled_before,)
+            )
+            return self._conn.execute("DELETE FROM documents WHERE crawled_at < ?", (crawled_before,)).rowcount
+
+    def close(self):
+        if not self.read_only:
+            # readers of a WAL database need to create its shared memory file, which fails if the index is deployed
+            # in a read only directory. The journal is switched back once the index has been written
+            self._conn.execute("PRAGMA journal_mode=DELETE")
+
+        self._conn.close()
+
+
+_index: KnowledgeIndex | None = None
+
+
+def get_knowledge_index() -> KnowledgeIndex | None:
+    """
+    Returns the shared read only index, or None if it hasn't been built
+    """
+    global _index
+
+    if _index is None and os.path.exists(INDEX_PATH):
+        _index = KnowledgeIndex(INDEX_PATH)
+
+    return _index
+
+
+def normalise_link(link: str) -> str | None:
+    """
+    Returns the url to crawl for a link, or None if it shouldn't be crawled
+    """
+    url, _ = urldefrag(link)
+
+    parts = urlsplit(url)
+
+    if parts.scheme not in ("http", "https") or site_for(url) is None:
+        return None
+
+    if parts.path.lower().endswith(SKIPPED_EXTENSIONS):
+        return None
+
+    return url
+
+
+async def load_robots(client: httpx.AsyncClient, site: str) -> RobotFileParser:
+    robots = RobotFileParser()
+
+    try:
+        response = await client.get(f"https://{site}/robots.txt")
+
+        robots.parse(response.text.splitlines() if response.status_code == 200 else [])
+    except httpx.HTTPError as e:
+        logger.warning(f"Error fetching robots.txt for {site}: {e!r}")
+        robots.parse([])
+
+    return robots
+
+
+async def crawl_page(
+    client: httpx.AsyncClient,
+    index: KnowledgeIndex,
+    url: str,
+    validators: tuple[str | None, str | None] | None,
+    stats: Counter,
+) -> list[str]:
+    """
+    Fetch a page and index it if it has changed. Returns the page's links
+    """
+    headers = {}
+
+    if validators is not None:
+        etag, last_modified = validators
+
+        if etag:
+            headers["If-None-Match"] = etag
+
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    try:
+        response = await client.get(url, headers=headers)
+    except httpx.HTTPError as e:
+        logger.warning(f"Error crawling {url}: {e!r}")
+        stats["errors"] += 1
+
+        # keep the page and carry on from its last known links
+        return index.links(url)
+
+    if response.status_code == 304:
+        index.touch(url)
+        stats["unchanged"] += 1
+
+        return index.links(url)
+
+    if response.status_code in (404, 410):
+        index.remove(url)
+        stats["removed"] += 1
+
+        return []
+
+    if response.status_code != 200 or "text/html" not in response.headers.get("Content-Type", ""):
+        return []
+
+    # pages that redirect off the site aren't indexed
+    site = site_for(str(response.url))
+
+    if site is None:
+        return []
+
+    # parsing is CPU bound, keep it off the event loop
+    title, text, links = await asyncio.to_thread(extract_page, response.text, str(response.url))
+
+    changed = index.upsert(
+        url,
+        site,
+        title,
+        text,
+        links,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+
+    stats["changed" if changed else "unchanged"] += 1
+
+    return links
+
+
+async def crawl_site(
+    client: httpx.AsyncClient,
+    index: KnowledgeIndex,
+    site: str,
+    validators: dict[str, tuple[str | None, str | None]],
+    stats: Counter,
+    max_pages: int = CRAWL_MAX_PAGES_PER_SITE,
+    concurrency: int = CRAWL_CONCURRENCY_PER_SITE,
+):
+    """
+    Breadth first crawl of a site, starting from its home page and every page already in the index
+    """
+    robots = await load_robots(client, site)
+
+    home = f"https://{site}/"
+
+    queue = [home] + [url for url in validators if site_for(url) == site and url != home]
+    seen = set(queue)
+    crawled = 0
+
+    while queue and crawled < max_pages:
+        batch = [url for url in queue[:concurrency] if robots.can_fetch(CRAWL_USER_AGENT, url)]
+        queue = queue[concurrency:]
+
+        crawled += len(batch)
+
+        results = await asyncio.gather(*(crawl_page(client, index, url, validators.get(url), stats) for url in batch))
+
+        for links in results:
+            for link in links:
+                url = normalise_link(link)
+
+                if url is not None and url not in seen:
+                    seen.add(url)
+                    queue.append(url)
+
+
+async def crawl(
+    sites: list[str] | None = None, # defaults to all of SITES
+    max_pages: int = CRAWL_MAX_PAGES_PER_SITE,
+    path: str = INDEX_PATH,
+) -> Counter:
+    """
+    Crawl the sites into the index. Pages already in the index are revalidated with conditional requests,
+    and are only re-indexed if their content has changed. Returns counts of changed, unchanged, removed and failed pages.
+    """
+    index = KnowledgeIndex(path, read_only=False)
+
+    validators = index.validators()
+    started_at = time.time()
+    stats = Counter()
+
+    async with httpx.AsyncClient(
+        timeout=CRAWL_TIMEOUT_SECONDS,
+        follow_redirects=True,
+        headers={"User-Agent": CRAWL_USER_AGENT},
+    ) as client:
+        await asyncio.gather(*(
+            crawl_site(client, index, site, validators, stats, max_pages=max_pages)
+            for site in (sites or SITES)
+        ))
+
+    stats["expired"] = index.remove_older_than(started_at - CRAWL_MAX_AGE_SECONDS)
+
+    index.close()
+
+    return stats
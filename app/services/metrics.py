@@ -0,0 +1,92 @@
+"""
+This module keeps simple in-process counters used to measure how the app behaves, e.g. the number of OpenAI calls made per message
+"""
+import re
+
+import time
+
+from collections import Counter, deque
+
+from contextlib import contextmanager
+
+from contextvars import ContextVar
+
+import httpx
+
+
+# Total OpenAI calls made by this process, keyed by endpoint
+OPENAI_CALLS = Counter()
+
+# OpenAI calls made while handling the current message, set by track_openai_calls()
+_message_openai_calls: ContextVar[Counter | None] = ContextVar("message_openai_calls", default=None)
+
+# Whatsapp replies delivered, failed and retried by this process, see services/whatsapp.py
+WHATSAPP_DELIVERIES = Counter()
+
+# Matches object ids in OpenAI urls, e.g. thread_abc123, run_abc123
+OPENAI_ID_PATTERN = re.compile(r"/(?:thread|run|asst|msg|step|call)_[A-Za-z0-9]+")
+
+
+@contextmanager
+def track_openai_calls():
+    """
+    Count the OpenAI calls made inside this block, including those made by tasks started inside it
+    """
+    counter = Counter()
+
+    token = _message_openai_calls.set(counter)
+
+    try:
+        yield counter
+    finally:
+        _message_openai_calls.reset(token)
+
+
+async def record_openai_request(request: httpx.Request):
+    """
+    httpx event hook, pass to the OpenAI client's http_client to count requests
+    """
+    endpoint = f"{request.method} {OPENAI_ID_PATTERN.sub('/:id', request.url.path)}"
+
+    OPENAI_CALLS[endpoint] += 1
+
+    counter = _message_openai_calls.get()
+
+    if counter is not None:
+        counter[endpoint] += 1
+
+
+class LatencyStats:
+    """
+    Keeps the most recent latencies of an operation, to report percentiles and throughput
+    """
+    def __init__(self, size: int = 1000):
+        self.count = 0
+
+        # (finished at, latency in seconds)
+        self._recent: deque[tuple[float, float]] = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self.count += 1
+        self._recent.append((time.monotonic(), seconds))
+
+    def summary(self) -> dict:
+        if not self._recent:
+            return {"count": self.count}
+
+        latencies = sorted(latency for _, latency in self._recent)
+        elapsed = time.monotonic() - self._recent[0][0]
+
+        return {
+            "count": self.count,
+            "p50_ms": round(1000 * latencies[len(latencies) // 2]),
+            "p95_ms": round(1000 * latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]),
+            "max_ms": round(1000 * latencies[-1]),
+            # over the recent latencies kept
+            "per_minute": round(60 * len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        }
+
+
+# Time Whatsapp replies wait in the outbound queue, and take to deliver including retries
+WHATSAPP_QUEUE_LATENCY = LatencyStats()
+WHATSAPP_SEND_LATENCY = LatencyStats()
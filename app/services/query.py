@@ -0,0 +1,236 @@
+"""
+This module normalises search queries so that differently worded queries for the same thing share a cache entry,
+and finds cached queries that are similar enough to a new query to reuse their results
+"""
+import os
+
+import re
+
+import math
+
+import time
+
+import threading
+
+from collections import Counter, defaultdict
+
+from typing import Callable, Iterable
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# Minimum IDF weighted Jaccard similarity for a cached query to be used in place of a new one. Set to 1 to disable.
+# A query that differs from a cached one by a single uncommon word, e.g. "refund", scores well under this
+SEARCH_SIMILARITY_THRESHOLD = float(os.getenv("SEARCH_SIMILARITY_THRESHOLD", 0.9))
+
+# How often the similarity index reloads keys from the cache, to pick up queries cached by other workers
+SIMILARITY_INDEX_REFRESH_SECONDS = float(os.getenv("SIMILARITY_INDEX_REFRESH", 60))
+
+STOP_WORDS = {
+    "a", "about", "am", "an", "and", "any", "are", "as", "at", "be", "by", "can", "could", "do", "does", "for",
+    "from", "get", "have", "how", "i", "if", "in", "is", "it", "me", "much", "my", "of", "on", "or", "please",
+    "tell", "that", "the", "there", "this", "to", "what", "when", "where", "which", "who", "will", "with",
+    "would", "you", "your",
+}
+
+# Names the partner colleges are referred to by, each folded to a single token. These are the keys used by the
+# assistant's tools, except for Future English as "future" is also a common word
+COLLEGE_ALIASES = {
+    "hilton academy": "hilton",
+    "hilton": "hilton",
+    "allied institute": "allied",
+    "allied": "allied",
+    "paragon polytechnic": "paragon",
+    "paragon": "paragon",
+    "collins academy": "collins",
+    "collins": "collins",
+    "future english": "futureenglish",
+    "everthought college of construction": "everthought",
+    "everthought college": "everthought",
+    "everthought": "everthought",
+    "ecoc": "everthought",
+}
+
+COLLEGES = set(COLLEGE_ALIASES.values())
+
+# Names of the colleges by the keys used by the assistant's tools
+COLLEGE_NAMES = {
+    "hilton": "Hilton Academy",
+    "allied": "Allied Institute",
+    "paragon": "Paragon Polytechnic",
+    "collins": "Collins Academy",
+    "future": "Future English",
+    "everthought": "Everthought College of Construction",
+}
+
+# Longest aliases are matched first so "hilton academy" is folded as a whole
+ALIAS_PATTERN = re.compile(
+    r"\b(" + "|".join(re.escape(alias) for alias in sorted(COLLEGE_ALIASES, key=len, reverse=True)) + r")\b"
+)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+def stem(token: str) -> str:
+    """
+    Light stemming so plurals match, e.g. "fees" and "fee"
+    """
+    if len(token) > 3 and token.endswith("s") and not token.endswith("ss"):
+        return token[:-1]
+
+    return token
+
+
+def tokenize(
+    text: str,
+    stop_words: set[str] = frozenset(),
+) -> list[str]:
+    """
+    Lowercase text and split it into stemmed tokens, leaving out stop words.
+    Stop words are removed before stemming so e.g. "does" isn't kept as "doe", and college keys such as "collins" aren't stemmed
+    """
+    return [
+        token if token in COLLEGES else stem(token)
+        for token in TOKEN_PATTERN.findall(text.casefold())
+        if token not in stop_words
+    ]
+
+
+def fold_aliases(text: str) -> str:
+    """
+    Lowercase text and replace college names with their key, e.g. "Hilton Academy" becomes "hilton"
+    """
+    return ALIAS_PATTERN.sub(lambda match: COLLEGE_ALIASES[match.group(1)], text.casefold())
+
+
+def normalise_query(
+    query: str,
+    college: str | None = None,
+) -> str:
+    """
+    Returns the canonical key for a query: case folded, college names folded to a single token,
+    punctuation and stop words removed, and the remaining tokens de-duplicated and sorted.
+    e.g. "Fees for cookery Hilton" and "hilton academy cookery fee?" both become "cookery fee hilton"
+    """
+    text = query
+
+    if college is not None:
+        text += f" {COLLEGE_NAMES.get(college.lower(), college)}"
+
+    tokens = set(tokenize(fold_aliases(text), STOP_WORDS))
+
+    return " ".join(sorted(tokens))
+
+
+def jaccard(
+    a: set[str],
+    b: set[str],
+    weight: Callable[[str], float] = lambda token: 1.0,
+) -> float:
+    if not a and not b:
+        return 1.0
+
+    return sum(map(weight, a & b)) / sum(map(weight, a | b))
+
+
+def is_pinned(token: str) -> bool:
+    """
+    Tokens that must be in both queries for them to match, i.e. colleges and numbers such as years
+    """
+    return token in COLLEGES or token.isdigit()
+
+
+class SimilarityIndex:
+    """
+    Inverted index from token to normalised query, used to find the most similar cached query by token-set Jaccard similarity.
+    Tokens are weighted by their inverse document frequency among the cached queries, so words used in many queries
+    (e.g. "course") count for little and words specific to a query (e.g. "refund") count for a lot.
+    Queries about different colleges or with different numbers never match each other.
+    """
+    def __init__(
+        self,
+        load_keys: Callable[[], Iterable[str]], # returns the keys currently in the cache
+        threshold: float = SEARCH_SIMILARITY_THRESHOLD,
+        refresh_interval: float = SIMILARITY_INDEX_REFRESH_SECONDS,
+    ):
+        self.threshold = threshold
+
+        self._load_keys = load_keys
+        self._refresh_interval = refresh_interval
+        self._loaded_at: float | None = None
+
+        self._keys: set[str] = set()
+        self._postings: defaultdict[str, set[str]] = defaultdict(set)
+        # number of keys each token appears in
+        self._frequencies: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self._refresh_interval:
+            return
+
+        keys = set(self._load_keys())
+
+        with self._lock:
+            self._keys = set()
+            self._postings = defaultdict(set)
+            self._frequencies = Counter()
+
+            for key in keys:
+                self._add(key)
+
+            self._loaded_at = time.monotonic()
+
+    def _add(self, key: str):
+        if key in self._keys:
+            return
+
+        self._keys.add(key)
+
+        for token in key.split():
+            self._postings[token].add(key)
+            self._frequencies[token] += 1
+
+    def _weight(self, token: str) -> float:
+        # smoothed so tokens that aren't in any key have the highest weight
+        return math.log((len(self._keys) + 1) / (self._frequencies[token] + 1)) + 1
+
+    def add(self, key: str):
+        with self._lock:
+            self._add(key)
+
+    def find(self, key: str) -> tuple[str, float] | None:
+        """
+        Returns the most similar indexed key and its similarity, if it meets the threshold
+        """
+        if self.threshold >= 1:
+            return None
+
+        self._refresh()
+
+        tokens = set(key.split())
+        pinned = set(filter(is_pinned, tokens))
+
+        with self._lock:
+            candidates = set().union(*(self._postings.get(token, set()) for token in tokens))
+
+            # the cache may have evicted keys since the index was loaded, those are skipped when looked up
+            best = None
+
+            for candidate in candidates:
+                if candidate == key:
+                    continue
+
+                candidate_tokens = set(candidate.split())
+
+                if set(filter(is_pinned, candidate_tokens)) != pinned:
+                    continue
+
+                similarity = jaccard(tokens, candidate_tokens, self._weight)
+
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (candidate, similarity)
+
+        return best
@@ -1,5 +1,5 @@
 """
-This module handles searching of the knowledge base using Google Custom Search Engine
+This module handles searching of the knowledge base using the local index (see services/index.py) or Google Custom Search Engine
 """
 import os
 
@@ -7,31 +7,73 @@ import logging
 
 import json
 
+import asyncio
+
+import time
+
+import hashlib
+
+import sqlite3
+
+from collections import defaultdict
+
 from functools import lru_cache
 
-import requests
+from urllib.parse import urlsplit
 
-from openai import OpenAI
+import httpx
 
-from googleapiclient.discovery import build
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
 
-from bs4 import BeautifulSoup
+from services.metrics import record_openai_request
+from services.extract import parse
+from services.cache import get_search_cache, get_page_cache, get_summary_cache, get_query_stats
+from services.index import get_knowledge_index
+from services.google_search import get_search_batcher
+from services.query import COLLEGE_NAMES, SimilarityIndex, normalise_query
+from services.context import format_passages, pack_context, query_coverage
+from services.singleflight import SingleFlight
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
 # Define constants
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-GOOGLE_CSE_ID = os.getenv("GOOGLE_CSE_ID")
+# Where searches are run. "index" uses the local index built by scripts/build_index.py, "google" uses Google Custom Search,
+# and "auto" uses the index if it has been built and falls back to Google if it hasn't or finds nothing
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "auto")
+
+# How search results are summarised for the assistant. "llm" summarises them with gpt-4o, "extractive" returns the passages
+# most relevant to the query without calling the model, and "auto" returns the passages if they cover enough of the query
+SEARCH_SUMMARY_MODE = os.getenv("SEARCH_SUMMARY_MODE", "llm")
+
+# Maximum tokens of passages returned in extractive mode
+EXTRACTIVE_TOKEN_BUDGET = int(os.getenv("EXTRACTIVE_TOKEN_BUDGET", 600))
+
+# In auto mode, passages are used if a page covers at least this fraction of the query's terms
+EXTRACTIVE_MIN_COVERAGE = float(os.getenv("EXTRACTIVE_MIN_COVERAGE", 0.75))
+
+# Tool output in extractive mode when none of the pages could be scraped or packed
+NO_PASSAGES_OUTPUT = "No relevant information was found on the college websites for this query."
+
+# Pages are fetched concurrently through a shared connection pool.
+# A slow site can hold up a search for at most SCRAPE_DEADLINE seconds
+SCRAPE_CONNECT_TIMEOUT_SECONDS = float(os.getenv("SCRAPE_CONNECT_TIMEOUT", 3))
+SCRAPE_READ_TIMEOUT_SECONDS = float(os.getenv("SCRAPE_READ_TIMEOUT", 8))
+SCRAPE_DEADLINE_SECONDS = float(os.getenv("SCRAPE_DEADLINE", 10))
+SCRAPE_MAX_CONNECTIONS = int(os.getenv("SCRAPE_MAX_CONNECTIONS", 20))
+SCRAPE_MAX_CONNECTIONS_PER_HOST = int(os.getenv("SCRAPE_MAX_CONNECTIONS_PER_HOST", 4))
+
+# How long a cached page is used without checking whether it has changed
+PAGE_MAX_AGE_SECONDS = float(os.getenv("PAGE_MAX_AGE", 60 * 60))
 
 logger = logging.getLogger(__name__)
 
 
-def summarise_search_results(
+async def summarise_search_results(
     query: str,
     search_results: list[dict],
-    client: OpenAI = OpenAI(),
+    client: AsyncOpenAI = AsyncOpenAI(http_client=DefaultAsyncHttpxClient(event_hooks={"request": [record_openai_request]})),
 ) -> str:
     system = (
         "You are part of a team of customer service assistants for Laurus Education, a provider of educational programs to Australian and international students. "
@@ -43,7 +85,7 @@ def summarise_search_results(
         + "Be as concise as possible and use no more than 100 words."
     )
 
-    completion = client.chat.completions.create(
+    completion = await client.chat.completions.create(
         model="gpt-4o", # must use gpt-4o for the context window
         messages=[
             {
@@ -62,100 +104,361 @@ def summarise_search_results(
     return completion.choices[0].message.content
 
 
-def clean_soup(soup: BeautifulSoup):
-    # remove all script, style, header and fotter elements
-    for script in soup(["script", "style", "a", "header", "footer", "nav"]):
-        script.extract()
+def summary_key(
+    query: str,
+    search_results: list[dict], # packed search results
+) -> str:
+    content = json.dumps([normalise_query(query), search_results], sort_keys=True)
 
-    # extract text
-    text = soup.get_text()
+    return hashlib.sha256(content.encode()).hexdigest()
 
-    # remove unnecessary line breaks and return as string
-    paragraphs = [p.strip() for p in text.split("\n\n") if p.strip()]
 
-    return "\n".join(paragraphs)
+async def cached_summary(
+    query: str,
+    search_results: list[dict],
+) -> str:
+    """
+    Summaries are reused when the same query is made on the same page content,
+    if any of the pages change the key changes and a new summary is made
+    """
+    cache = get_summary_cache()
+
+    key = summary_key(query, search_results)
+
+    summary = await cache.get_async(key)
+
+    if summary is not None:
+        return summary
+
+    summary = await summarise_search_results(query, search_results)
+
+    await cache.set_async(key, summary)
+
+    return summary
+
+
+async def summarise(
+    query: str,
+    scraped_results: list[dict],
+) -> str:
+    """
+    Returns the search tool's output for the scraped pages, see SEARCH_SUMMARY_MODE
+    """
+    # packing is CPU bound, keep it off the event loop
+    if SEARCH_SUMMARY_MODE != "llm":
+        passages = await asyncio.to_thread(pack_context, query, scraped_results, EXTRACTIVE_TOKEN_BUDGET)
 
+        if SEARCH_SUMMARY_MODE == "extractive":
+            return format_passages(passages) if passages else NO_PASSAGES_OUTPUT
+
+        coverage = query_coverage(query, passages)
+
+        if coverage >= EXTRACTIVE_MIN_COVERAGE:
+            return format_passages(passages)
+
+        logger.info(f" Passages cover {coverage:.0%} of '{query}', summarising instead")
+
+    # only the passages relevant to the query are summarised
+    packed_results = await asyncio.to_thread(pack_context, query, scraped_results)
+
+    return await cached_summary(query, packed_results)
+
+
+_http_client: httpx.AsyncClient | None = None
+
+# limits concurrent requests to each host, so one search can't flood a single college site
+_host_semaphores: defaultdict[str, asyncio.Semaphore] = defaultdict(lambda: asyncio.Semaphore(SCRAPE_MAX_CONNECTIONS_PER_HOST))
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Shared client for fetching pages, so keep-alive connections are reused between searches
+    """
+    global _http_client
+
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(SCRAPE_READ_TIMEOUT_SECONDS, connect=SCRAPE_CONNECT_TIMEOUT_SECONDS),
+            limits=httpx.Limits(
+                max_connections=SCRAPE_MAX_CONNECTIONS,
+                max_keepalive_connections=SCRAPE_MAX_CONNECTIONS,
+            ),
+            follow_redirects=True,
+        )
+
+    return _http_client
+
+
+async def close_http_client():
+    if _http_client is not None:
+        await _http_client.aclose()
+
+
+async def scrape(url):
+    """
+    Returns the text content of a page.
+    Extracted text is cached by url. Pages fetched within PAGE_MAX_AGE are served from the cache without a request,
+    older pages are revalidated with a conditional request so unchanged pages don't need to be downloaded or parsed again.
+    """
+    cache = get_page_cache()
+
+    cached = await cache.get_async(url, record_stats=False)
+
+    if cached is not None and time.time() - cached["fetched_at"] < PAGE_MAX_AGE_SECONDS:
+        await cache.record_async("hits")
+        return cached["text"]
+
+    headers = {}
+
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
 
-def scrape(url):
     try:
-        html = requests.get(url).text
-        soup = BeautifulSoup(html, "html.parser")
+        async with _host_semaphores[urlsplit(url).netloc]:
+            response = await get_http_client().get(url, headers=headers)
+
+        if response.status_code == 304 and cached is not None:
+            await cache.record_async("revalidated")
+            await cache.set_async(url, {**cached, "fetched_at": time.time()})
+
+            return cached["text"]
 
-        return clean_soup(soup)
+        response.raise_for_status()
+
+        # parsing is CPU bound, keep it off the event loop
+        text = await asyncio.to_thread(parse, response.text)
+
+        await cache.record_async("misses")
+        await cache.set_async(url, {
+            "text": text,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        })
+
+        return text
     except Exception as e:
-        print(e)
-        return None
+        logger.warning(f"Error scraping {url}: {e!r}")
+
+        # fall back to the last version of the page if there is one
+        return cached["text"] if cached is not None else None
+
 
+async def scrape_result(item: dict):
+    # results from the local index already include the page text
+    if "text" in item:
+        return item["text"]
 
-def scrape_webpages(
+    return await scrape(item["link"])
+
+
+async def scrape_webpages(
     results: list[dict],
     # Maximum characters to be returned. If too long, results will not fit inside gpt-4o context window plus function will run too long
     max_length = 30_000,
+    deadline_seconds: float = SCRAPE_DEADLINE_SECONDS,
 ):
     """
-    Returns text content of pages return by Google Search query
+    Returns text content of pages returned by the search.
+    Pages are fetched concurrently and processed as they finish, any still loading at the deadline are skipped.
     """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + deadline_seconds
+
+    # map of pending fetch to its rank in the search results
+    pending = {
+        asyncio.create_task(scrape_result(item)): rank
+        for rank, item in enumerate(results)
+    }
 
     # Keep track of total length
     total_length = 0
 
     scraped_results = []
 
-    for item in results:
-        url = item["link"]
+    try:
+        while pending and total_length < 0.95 * max_length:
+            done, _ = await asyncio.wait(pending, timeout=max(deadline - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED)
 
-        text = scrape(url)
+            if not done:
+                logger.warning(f"Scraping deadline reached, skipping {len(pending)} pages")
+                break
 
-        length = len(text)
+            for task in done:
+                rank = pending.pop(task)
+                text = task.result()
 
-        should_break = False
-        # Truncate text to fit inside maximum context window if necessary
-        if total_length + length > 0.95 * max_length:
-            text = text[:max_length - total_length]
-            should_break = True
+                if text is None or total_length >= 0.95 * max_length:
+                    continue
 
-        scraped_results.append({
-            "title": item["title"],
-            "url": url,
-            "text": text,
-        })
+                # Truncate text to fit inside maximum context window if necessary
+                if total_length + len(text) > 0.95 * max_length:
+                    text = text[:max_length - total_length]
+
+                scraped_results.append((rank, {
+                    "title": results[rank]["title"],
+                    "url": results[rank]["link"],
+                    "text": text,
+                }))
 
-        total_length += length
+                total_length += len(text)
 
-        if should_break:
-            break
+    finally:
+        for task in pending:
+            task.cancel()
 
-    return scraped_results
+    # return pages in the order they were ranked by the search
+    return [result for _, result in sorted(scraped_results, key=lambda item: item[0])]
 
 
-def conduct_search(
+async def conduct_search(
     query: str,
     site: str | None = None, # limit results to specific site
     num: int = 3, # number search results to return
 ) -> list[dict]:
-    # see Custom Search Engine docs below
-    # https://google-api-client-libraries.appspot.com/documentation/customsearch/v1/python/latest/customsearch_v1.cse.html
+    if SEARCH_BACKEND != "google":
+        index = get_knowledge_index()
+
+        if index is not None:
+            try:
+                results = await asyncio.to_thread(index.search, query, num, site)
+
+            except sqlite3.Error as e:
+                if SEARCH_BACKEND == "index":
+                    raise
+
+                logger.warning(f"Error searching knowledge index, searching Google instead: {e!r}")
 
-    resource = build("customsearch", "v1", developerKey=GOOGLE_API_KEY).cse()
-    result = resource.list(q=query, num=num, siteSearch=site, cx=GOOGLE_CSE_ID).execute()
+                results = []
 
-    return result["items"][:num]
+            if results or SEARCH_BACKEND == "index":
+                return results
 
+        elif SEARCH_BACKEND == "index":
+            logger.warning("Knowledge index has not been built, run scripts/build_index.py")
+            return []
 
-# Apply LRU cache to eliminate duplicate requests
-@lru_cache(maxsize=128)
-def cached_search(
+    return await get_search_batcher().search(query, site, num)
+
+
+@lru_cache(maxsize=1)
+def get_similarity_index() -> SimilarityIndex:
+    return SimilarityIndex(get_search_cache().keys)
+
+
+@lru_cache(maxsize=1)
+def get_search_flight() -> SingleFlight:
+    return SingleFlight("search")
+
+
+async def cached_search(
     query: str
-):
-    search_results = conduct_search(query)
+) -> tuple[list[dict], str, bool]:
+    """
+    Returns search results, summary, and whether the result came from the cache.
+    Results are cached on disk with a TTL to eliminate duplicate requests, see services/cache.py.
+    The cache is keyed on the normalised query, and if there is no entry for it the results for a similar query are used instead.
+    """
+    cache = get_search_cache()
+
+    key = normalise_query(query)
+
+    cached = await cache.get_async(key, record_stats=False)
+
+    if cached is not None:
+        await cache.record_async("hits")
+
+        return cached["search_results"], cached["summary"], True
+
+    similar = await asyncio.to_thread(get_similarity_index().find, key)
+
+    if similar is not None:
+        similar_key, similarity = similar
 
-    scraped_results = scrape_webpages(search_results)
+        cached = await cache.get_async(similar_key, record_stats=False)
 
-    summary = summarise_search_results(query, scraped_results)
+        if cached is not None:
+            logger.info(f" Using cached results for '{similar_key}' in place of '{key}' (similarity {similarity:.2f})")
+
+            await cache.record_async("similar_hits")
+
+            return cached["search_results"], cached["summary"], True
+
+    searched = False
+
+    async def search() -> tuple[list[dict], str]:
+        nonlocal searched
+        searched = True
+
+        await cache.record_async("misses")
+
+        return await refresh_search(query)
+
+    # concurrent searches for the same query share one search, see services/singleflight.py
+    search_results, summary = await get_search_flight().run(key, search, lambda: load_search(key))
+
+    # only the caller that ran the search counts as a miss, the others shared its result
+    if not searched:
+        await cache.record_async("shared_hits")
+
+    return search_results, summary, False
+
+
+async def load_search(
+    key: str, # normalised query
+    fresh_for: float = 0,
+) -> tuple[list[dict], str] | None:
+    """
+    Returns the cached results and summary for a query, or None if there aren't any that are valid for another fresh_for seconds
+    """
+    cache = get_search_cache()
+
+    if fresh_for > 0:
+        expires_at = await cache.expires_at_async(key)
+
+        if expires_at is None or expires_at - time.time() <= fresh_for:
+            return None
+
+    cached = await cache.get_async(key, record_stats=False)
+
+    return (cached["search_results"], cached["summary"]) if cached is not None else None
+
+
+async def refresh_search(
+    query: str
+) -> tuple[list[dict], str]:
+    """
+    Run the search and store the results and summary in the cache, replacing any existing entry
+    """
+    search_results = await conduct_search(query)
+
+    scraped_results = await scrape_webpages(search_results)
+
+    summary = await summarise(query, scraped_results)
+
+    # page text from the local index is only needed for the summary
+    search_results = [
+        {field: value for field, value in item.items() if field != "text"}
+        for item in search_results
+    ]
+
+    key = normalise_query(query)
+
+    await get_search_cache().set_async(key, {
+        "search_results": search_results,
+        "summary": summary,
+    })
+
+    get_similarity_index().add(key)
 
     return search_results, summary
 
-def search_tool(
+
+async def search_tool(
     query: str,
     college: str | None = None
 ):
@@ -163,14 +466,16 @@ def search_tool(
     This is the tool the AI Assistant will use to search webpages to answer user's enquiry
     """
     if college is not None:
-        if college.lower() not in query.lower():
-            query += f" {college}"
+        # the college's name is added rather than its key, so it is folded like the rest of the query and searched for by name
+        name = COLLEGE_NAMES.get(college.lower(), college)
 
-    hits_before = cached_search.cache_info().hits
+        if not set(normalise_query(name).split()) <= set(normalise_query(query).split()):
+            query += f" {name}"
 
-    search_results, summary = cached_search(query)
+    search_results, summary, cached = await cached_search(query)
 
-    hits_after = cached_search.cache_info().hits
+    # frequent queries are kept in the cache by services/warmer.py
+    await get_query_stats().record_async(normalise_query(query), query)
 
     formatted_search_results = json.dumps([
         {
@@ -182,6 +487,8 @@ def search_tool(
     logger.info(f" Searched for: {query}")
     logger.info(f" Top results: {formatted_search_results}")
     logger.info(f" Extracted: {summary}")
-    logger.info(f" Cached: {hits_before < hits_after}")
+    stats = await get_search_cache().stats_async()
+
+    logger.info(f" Cached: {cached} (hit rate {stats['hit_rate']:.0%} over {stats['lookups']} searches)")
 
     return summary
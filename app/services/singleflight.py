@@ -0,0 +1,142 @@
+"""
+This module makes sure only one search runs at a time for each query, when several students ask the same thing at once.
+Callers in the same process wait on the search that is already running and share its result.
+Worker processes coordinate through a lock table in the cache database, a worker that doesn't hold the lock
+waits for the result to appear in the cache instead of running the search itself.
+"""
+import os
+
+import time
+
+import uuid
+
+import asyncio
+
+import logging
+
+import threading
+
+from typing import Awaitable, Callable, TypeVar
+
+from services.cache import CACHE_PATH
+from services.storage import connect_sqlite
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# How long a lock is held before other workers assume its holder has died. Should be longer than a search takes
+SINGLE_FLIGHT_LOCK_TTL_SECONDS = float(os.getenv("SINGLE_FLIGHT_LOCK_TTL", 120))
+
+# How often workers waiting on another worker check for its result
+SINGLE_FLIGHT_POLL_SECONDS = float(os.getenv("SINGLE_FLIGHT_POLL", 0.25))
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """
+    Runs one computation at a time for each key, in this process and across processes sharing the cache database
+    """
+    def __init__(
+        self,
+        name: str, # locks are namespaced so different computations can share the table
+        lock_ttl: float = SINGLE_FLIGHT_LOCK_TTL_SECONDS,
+        poll_interval: float = SINGLE_FLIGHT_POLL_SECONDS,
+        path: str = CACHE_PATH,
+    ):
+        self.name = name
+        self.lock_ttl = lock_ttl
+        self.poll_interval = poll_interval
+
+        self._conn = connect_sqlite(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS locks (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                PRIMARY KEY (name, key)
+            )
+        """)
+
+        self._lock = threading.Lock()
+
+        # key -> task computing it in this process
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    def _acquire(self, key: str, owner: str) -> bool:
+        now = time.time()
+
+        with self._lock:
+            # takes the lock if it is free or its holder's lock has expired
+            cursor = self._conn.execute(
+                """
+                INSERT INTO locks (name, key, owner, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (name, key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE locks.expires_at <= ?
+                """,
+                (self.name, key, owner, now + self.lock_ttl, now),
+            )
+
+            return cursor.rowcount == 1
+
+    def _release(self, key: str, owner: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM locks WHERE name = ? AND key = ? AND owner = ?", (self.name, key, owner))
+
+    async def run(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[T]], # runs the computation and stores its result where load() can read it
+        load: Callable[[], Awaitable[T | None]], # returns the stored result, or None if there isn't one
+    ) -> T:
+        task = self._in_flight.get(key)
+
+        if task is None:
+            task = asyncio.create_task(self._run(key, compute, load))
+
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            logger.info(f" Waiting on search already running for '{key}'")
+
+        # one caller giving up doesn't cancel the computation for the others
+        return await asyncio.shield(task)
+
+    async def _run(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[T]],
+        load: Callable[[], Awaitable[T | None]],
+    ) -> T:
+        owner = uuid.uuid4().hex
+        waited = False
+
+        while True:
+            if await asyncio.to_thread(self._acquire, key, owner):
+                try:
+                    # another worker may have finished between our cache miss and taking the lock
+                    result = await load()
+
+                    if result is not None:
+                        return result
+
+                    return await compute()
+                finally:
+                    await asyncio.to_thread(self._release, key, owner)
+
+            if not waited:
+                logger.info(f" Waiting on search running in another worker for '{key}'")
+                waited = True
+
+            await asyncio.sleep(self.poll_interval)
+
+            # if the other worker failed its lock is released and the next attempt takes it
+            result = await load()
+
+            if result is not None:
+                return result
@@ -1,82 +1,554 @@
 """
-This module handles storing of OpenAI Thread IDs with DynamoDB
+This module handles storing of OpenAI Thread IDs.
+
+Records are kept in a ThreadStore. Locally this is a single, long-lived SQLite connection running in WAL mode,
+with a small in-process read cache in front of it so repeat lookups for the same user don't read and parse the record again.
+The cache is cleared whenever another connection, e.g. another worker process, has written to the database since it was last checked.
+When deployed, records are kept in the DynamoDB table created in template.yaml so they survive between Lambda containers.
 """
 import os
 
+import json
+
+import asyncio
+
+import sqlite3
+
+import threading
+
+import heapq
+
+import logging
+
+from abc import ABC, abstractmethod
+
+from functools import lru_cache
+
+from collections import OrderedDict
+
 from datetime import datetime, timedelta
 
-import shelve
+from dotenv import load_dotenv
 
+load_dotenv()
 
-# Directory for shelve module
+
+logger = logging.getLogger(__name__)
+
+# Directory for the thread store
 DIRECTORY = "storage"
-FILE_NAME = "thread_store"
+FILE_NAME = "thread_store.db"
 PATH = f"{DIRECTORY}/{FILE_NAME}"
 
+# Maximum number of records held in the in-process read cache
+READ_CACHE_SIZE = int(os.getenv("THREAD_STORE_CACHE_SIZE", 10_000))
+
+# OpenAI threads expire after 30 days
+THREAD_EXPIRY = timedelta(days=30)
+
+# Backend used to store threads, one of "sqlite", "dynamodb" or "memory"
+# Defaults to DynamoDB when the TABLE_NAME from template.yaml is present
+TABLE_NAME = os.getenv("TABLE_NAME")
+THREAD_STORE = os.getenv("THREAD_STORE", "dynamodb" if TABLE_NAME else "sqlite")
+
+# Optional endpoint override, e.g. http://localhost:8000 for DynamoDB Local
+DYNAMODB_ENDPOINT_URL = os.getenv("DYNAMODB_ENDPOINT_URL") or None
+
+# How often the background sweeper removes expired records, and how many it removes per statement
+SWEEP_INTERVAL_SECONDS = float(os.getenv("THREAD_STORE_SWEEP_INTERVAL", 3600))
+SWEEP_BATCH_SIZE = 500
+
+# SQL statements are defined once so the connection's statement cache reuses the prepared statements
+CREATE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS threads (
+    id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated_at REAL NOT NULL
+)
+"""
+# Expiry index, keeps records ordered by last update so the sweeper only visits the expired head
+CREATE_INDEX_SQL = "CREATE INDEX IF NOT EXISTS threads_updated_at ON threads (updated_at)"
+SELECT_SQL = "SELECT data FROM threads WHERE id = ?"
+# Changes when another connection commits to the database, writes made on this connection don't change it
+DATA_VERSION_SQL = "PRAGMA data_version"
+UPSERT_SQL = "INSERT OR REPLACE INTO threads (id, data, updated_at) VALUES (?, ?, ?)"
+UPDATE_SQL = "UPDATE threads SET data = json_set(data, '$.student_type', ?, '$.updated_at', ?), updated_at = ? WHERE id = ? RETURNING data"
+DELETE_EXPIRED_SQL = """
+DELETE FROM threads WHERE id IN (
+    SELECT id FROM threads WHERE updated_at < ? ORDER BY updated_at LIMIT ?
+) RETURNING id
+"""
+
+
+def connect_sqlite(path: str) -> sqlite3.Connection:
+    """
+    Open a SQLite connection that can be shared between threads, in WAL mode so other processes can read while one writes
+    """
+    directory = os.path.dirname(path)
+
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+
+    conn = sqlite3.connect(
+        path,
+        check_same_thread=False, # connection is shared between request threads
+        isolation_level=None, # autocommit, each statement is its own transaction
+        cached_statements=32,
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000") # other worker processes may hold the write lock
+
+    return conn
+
+
+class ThreadStore(ABC):
+    """
+    Interface for thread stores. Records are plain dicts keyed by user id.
+    """
+    @abstractmethod
+    def get(self, user_id: str) -> dict | None:
+        ...
+
+    @abstractmethod
+    def put(self, user_id: str, record: dict):
+        ...
+
+    @abstractmethod
+    def update_student_type(self, user_id: str, student_type: str) -> dict | None:
+        """
+        Update student type of an existing record. Returns the updated record or None if it does not exist.
+        """
+        ...
+
+    def delete_older_than(self, cutoff: datetime) -> int:
+        """
+        Delete records last updated before cutoff. Stores with native expiry don't need to do anything.
+        """
+        return 0
+
+    def close(self):
+        pass
+
+
+class SQLiteThreadStore(ThreadStore):
+    """
+    Thread store backed by one shared SQLite connection.
+    Access to the connection is serialised with a lock, which is only ever held for a single statement.
+    """
+    def __init__(
+        self,
+        path: str = PATH,
+        cache_size: int = READ_CACHE_SIZE,
+    ):
+        self._conn = connect_sqlite(path)
+        self._conn.execute(CREATE_TABLE_SQL)
+        self._conn.execute(CREATE_INDEX_SQL)
+
+        self._lock = threading.Lock()
+
+        self._cache: OrderedDict[str, dict] = OrderedDict()
+        self._cache_size = cache_size
+        self._data_version = self._conn.execute(DATA_VERSION_SQL).fetchone()[0]
+
+    def _validate_cache(self):
+        # records written by other connections may be newer than the cached ones
+        data_version = self._conn.execute(DATA_VERSION_SQL).fetchone()[0]
+
+        if data_version != self._data_version:
+            self._cache.clear()
+            self._data_version = data_version
+
+    def _cache_put(self, user_id: str, record: dict):
+        self._cache[user_id] = record
+        self._cache.move_to_end(user_id)
+
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, user_id: str) -> dict | None:
+        with self._lock:
+            self._validate_cache()
+
+            record = self._cache.get(user_id)
+
+            if record is not None:
+                self._cache.move_to_end(user_id)
+                return dict(record)
+
+            row = self._conn.execute(SELECT_SQL, (user_id,)).fetchone()
+
+            if row is None:
+                return None
+
+            record = json.loads(row[0])
+            self._cache_put(user_id, record)
+
+            return dict(record)
+
+    def put(self, user_id: str, record: dict):
+        updated_at = datetime.fromisoformat(record["updated_at"]).timestamp()
+
+        with self._lock:
+            self._conn.execute(UPSERT_SQL, (user_id, json.dumps(record), updated_at))
+            self._cache_put(user_id, dict(record))
+
+    def update_student_type(self, user_id: str, student_type: str) -> dict | None:
+        """
+        Update student type in a single statement. Returns the updated record or None if it does not exist.
+        """
+        now = datetime.now()
+
+        with self._lock:
+            row = self._conn.execute(UPDATE_SQL, (student_type, now.isoformat(), now.timestamp(), user_id)).fetchone()
+
+            if row is None:
+                self._cache.pop(user_id, None)
+                return None
+
+            record = json.loads(row[0])
+            self._cache_put(user_id, record)
+
+            return dict(record)
+
+    def delete_older_than(self, cutoff: datetime, batch_size: int = SWEEP_BATCH_SIZE) -> int:
+        """
+        Delete records last updated before cutoff. Returns the number of records deleted.
+        Deletes are walked off the head of the expiry index in batches so the lock is never held for long.
+        """
+        deleted = 0
+
+        while True:
+            with self._lock:
+                rows = self._conn.execute(DELETE_EXPIRED_SQL, (cutoff.timestamp(), batch_size)).fetchall()
+
+                for (user_id,) in rows:
+                    self._cache.pop(user_id, None)
+
+            deleted += len(rows)
+
+            if len(rows) < batch_size:
+                return deleted
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+            self._cache.clear()
+
+
+class InMemoryThreadStore(ThreadStore):
+    """
+    Thread store held in process memory. Used as a stand-in for the other backends when testing offline.
+    """
+    def __init__(self):
+        self._records: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+        # heap of (updated_at, user_id), entries are skipped if the record has since been updated
+        self._expiry: list[tuple[str, str]] = []
+
+    def get(self, user_id: str) -> dict | None:
+        with self._lock:
+            record = self._records.get(user_id)
+
+            return dict(record) if record is not None else None
+
+    def put(self, user_id: str, record: dict):
+        with self._lock:
+            self._records[user_id] = dict(record)
+            heapq.heappush(self._expiry, (record["updated_at"], user_id))
+
+    def update_student_type(self, user_id: str, student_type: str) -> dict | None:
+        with self._lock:
+            if user_id not in self._records:
+                return None
 
-def configure_storage():
+            record = {
+                **self._records[user_id],
+                "student_type": student_type,
+                "updated_at": datetime.now().isoformat(),
+            }
+
+            self._records[user_id] = record
+            heapq.heappush(self._expiry, (record["updated_at"], user_id))
+
+            return dict(record)
+
+    def delete_older_than(self, cutoff: datetime) -> int:
+        cutoff = cutoff.isoformat()
+        deleted = 0
+
+        with self._lock:
+            while self._expiry and self._expiry[0][0] < cutoff:
+                updated_at, user_id = heapq.heappop(self._expiry)
+
+                record = self._records.get(user_id)
+
+                if record is not None and record["updated_at"] == updated_at:
+                    del self._records[user_id]
+                    deleted += 1
+
+        return deleted
+
+
+@lru_cache(maxsize=1)
+def get_dynamodb_client():
     """
-    Create directory for storage if it doesn't exist
+    Create the DynamoDB client once so its connection pool is reused for the lifetime of the container
     """
-    if not os.path.exists(DIRECTORY):
-        os.makedirs(DIRECTORY)
+    # boto3 is only needed when using the DynamoDB backend
+    import boto3
+
+    from botocore.config import Config
+
+    return boto3.client(
+        "dynamodb",
+        endpoint_url=DYNAMODB_ENDPOINT_URL,
+        config=Config(
+            max_pool_connections=50,
+            retries={"max_attempts": 3, "mode": "adaptive"},
+        ),
+    )
+
+
+class DynamoDBThreadStore(ThreadStore):
+    """
+    Thread store backed by DynamoDB.
+    Each operation is a single request, and expiry is handled by the table's native TTL on the 'expires_at' attribute.
+    """
+    def __init__(
+        self,
+        table_name: str = TABLE_NAME,
+        client = None,
+    ):
+        if not table_name:
+            raise ValueError("TABLE_NAME must be set to use the DynamoDB thread store")
+
+        self._table_name = table_name
+        self._client = client or get_dynamodb_client()
+
+    @staticmethod
+    def _expires_at(updated_at: str) -> str:
+        return str(int((datetime.fromisoformat(updated_at) + THREAD_EXPIRY).timestamp()))
+
+    @staticmethod
+    def _to_attribute(value) -> dict:
+        if value is None:
+            return {"NULL": True}
+
+        # lists such as pending_messages are stored as JSON strings
+        if isinstance(value, (list, dict)):
+            return {"S": json.dumps(value)}
+
+        return {"S": str(value)}
+
+    @staticmethod
+    def _from_item(item: dict) -> dict:
+        record = {
+            key: None if "NULL" in value else value["S"]
+            for key, value in item.items()
+            if key not in ("id", "expires_at")
+        }
+
+        if record.get("pending_messages") is not None:
+            record["pending_messages"] = json.loads(record["pending_messages"])
+
+        return record
+
+    def get(self, user_id: str) -> dict | None:
+        response = self._client.get_item(
+            TableName=self._table_name,
+            Key={"id": {"S": user_id}},
+            ConsistentRead=True,
+        )
+
+        item = response.get("Item")
+
+        return self._from_item(item) if item is not None else None
+
+    def put(self, user_id: str, record: dict):
+        item = {
+            key: self._to_attribute(value)
+            for key, value in record.items()
+        }
+
+        self._client.put_item(
+            TableName=self._table_name,
+            Item={
+                **item,
+                "id": {"S": user_id},
+                "expires_at": {"N": self._expires_at(record["updated_at"])},
+            },
+        )
+
+    def update_student_type(self, user_id: str, student_type: str) -> dict | None:
+        updated_at = datetime.now().isoformat()
+
+        try:
+            # conditional update in place of reading the record and writing it back
+            response = self._client.update_item(
+                TableName=self._table_name,
+                Key={"id": {"S": user_id}},
+                UpdateExpression="SET student_type = :student_type, updated_at = :updated_at, expires_at = :expires_at",
+                ConditionExpression="attribute_exists(id)",
+                ExpressionAttributeValues={
+                    ":student_type": {"NULL": True} if student_type is None else {"S": student_type},
+                    ":updated_at": {"S": updated_at},
+                    ":expires_at": {"N": self._expires_at(updated_at)},
+                },
+                ReturnValues="ALL_NEW",
+            )
+
+        except self._client.exceptions.ConditionalCheckFailedException:
+            return None
+
+        return self._from_item(response["Attributes"])
+
+
+_store: ThreadStore | None = None
+_store_lock = threading.Lock()
+
+_sweeper: threading.Thread | None = None
+_sweeper_stop = threading.Event()
+
+
+def configure_storage(store: ThreadStore | None = None):
+    """
+    Open the thread store configured by THREAD_STORE, creating the directory for local storage if it doesn't exist.
+    A store may also be passed in directly, e.g. an InMemoryThreadStore when testing.
+    """
+    global _store
+
+    with _store_lock:
+        if store is not None:
+            _store = store
+
+        if _store is not None:
+            return _store
+
+        match THREAD_STORE:
+            case "dynamodb":
+                _store = DynamoDBThreadStore(TABLE_NAME)
+
+            case "memory":
+                _store = InMemoryThreadStore()
+
+            case "sqlite":
+                _store = SQLiteThreadStore(PATH)
+
+            case _:
+                raise ValueError(f"Unknown thread store '{THREAD_STORE}'")
+
+        return _store
+
+
+def get_store() -> ThreadStore:
+    if _store is None:
+        return configure_storage()
+
+    return _store
+
+
+def is_expired(record: dict) -> bool:
+    updated_at = record.get("updated_at")
+
+    if updated_at is None:
+        return True
+
+    return datetime.fromisoformat(updated_at) < datetime.now() - THREAD_EXPIRY
 
 
 def get_item_if_exists(user_id: str):
-    cleanup_old_threads()
+    record = get_store().get(user_id)
 
-    with shelve.open(PATH) as store:
-        return store.get(user_id, None)
+    # expired records are left for the sweeper to delete
+    if record is None or is_expired(record):
+        return None
 
+    return record
 
-def store_thread(user_id: str, thread_id: str):
+
+def store_thread(
+    user_id: str,
+    thread_id: str | None, # None until the user's first message that runs the assistant
+    student_type: str | None = None,
+    pending_messages: list[dict] | None = None, # messages to add to the thread once it is created
+):
     """
     Store thread id associated with user id
     """
-    with shelve.open(PATH) as store:
-        store[user_id] = {
-            "thread_id": thread_id,
-            "student_type": None,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat(),
-        }
+    get_store().put(user_id, {
+        "thread_id": thread_id,
+        "student_type": student_type,
+        "pending_messages": pending_messages or [],
+        "created_at": datetime.now().isoformat(),
+        "updated_at": datetime.now().isoformat(),
+    })
 
 
 def update_thread(user_id: str, student_type: str):
     """
     Update student type for thread
     """
-    current_value = get_item_if_exists(user_id)
-
-    if current_value is None:
+    if get_store().update_student_type(user_id, student_type) is None:
         raise Exception("Attempted to update value that does not exist")
 
-    with shelve.open(PATH) as store:
-        store[user_id] = {
-            **current_value,
-            "student_type": student_type,
-            "updated_at": datetime.now().isoformat(),
-        }
+
+# Async variants of the above for use from the event loop.
+# The store backends (sqlite3, boto3) are blocking, so each call runs in a worker thread.
+
+async def get_item_if_exists_async(user_id: str):
+    return await asyncio.to_thread(get_item_if_exists, user_id)
+
+
+async def store_thread_async(
+    user_id: str,
+    thread_id: str | None,
+    student_type: str | None = None,
+    pending_messages: list[dict] | None = None,
+):
+    await asyncio.to_thread(store_thread, user_id, thread_id, student_type, pending_messages)
+
+
+async def update_thread_async(user_id: str, student_type: str):
+    await asyncio.to_thread(update_thread, user_id, student_type)
 
 
 def cleanup_old_threads():
     """
     OpenAI threads expire after 30 days. Remove records where 'updated_at' is more than 30 days ago
     """
-    three_months_ago = datetime.now() - timedelta(days=30)
+    deleted = get_store().delete_older_than(datetime.now() - THREAD_EXPIRY)
+
+    if deleted > 0:
+        logger.info(f"Removed {deleted} expired threads")
+
+    return deleted
+
+
+def _sweep(interval: float):
+    while not _sweeper_stop.wait(interval):
+        try:
+            cleanup_old_threads()
 
-    with shelve.open(PATH, writeback=True) as store:
-        keys_to_delete = []
+        except Exception as e:
+            logger.error(f"Error removing expired threads: {e}")
+
+
+def start_cleanup_sweeper(interval: float = SWEEP_INTERVAL_SECONDS):
+    """
+    Start a background thread that removes expired records on a schedule, off the request path
+    """
+    global _sweeper
 
-        for user_id, data in store.items():
-            updated_at = data.get("updated_at")
+    with _store_lock:
+        if _sweeper is not None and _sweeper.is_alive():
+            return
 
-            if updated_at is None:
-                keys_to_delete.append(user_id)
-                continue
+        _sweeper_stop.clear()
+        _sweeper = threading.Thread(target=_sweep, args=(interval,), name="thread-store-sweeper", daemon=True)
+        _sweeper.start()
 
-            if datetime.fromisoformat(updated_at) < three_months_ago:
-                keys_to_delete.append(user_id)
 
-        for key in keys_to_delete:
-            del store[key]
\ No newline at end of file
+def stop_cleanup_sweeper():
+    _sweeper_stop.set()
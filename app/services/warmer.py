@@ -0,0 +1,83 @@
+"""
+This module keeps the most frequent searches in the cache, so the first student to ask about a popular topic
+after the cache expires doesn't have to wait for a new search.
+Queries are counted by search_tool, and the top CACHE_WARM_TOP_N are searched again before their cache entry expires.
+Run it in the app by setting CACHE_WARM_INTERVAL, or on a schedule with scripts/warm_cache.py.
+"""
+import os
+
+import time
+
+import asyncio
+
+import logging
+
+from services.cache import get_search_cache, get_query_stats
+from services.search import get_search_flight, load_search, refresh_search
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# How often the cache is warmed by the app, in seconds. 0 disables warming in the app
+CACHE_WARM_INTERVAL_SECONDS = float(os.getenv("CACHE_WARM_INTERVAL", 0))
+
+# Number of most frequent queries kept warm
+CACHE_WARM_TOP_N = int(os.getenv("CACHE_WARM_TOP_N", 20))
+
+# Entries that expire within CACHE_WARM_AHEAD seconds are refreshed. Should be longer than CACHE_WARM_INTERVAL
+CACHE_WARM_AHEAD_SECONDS = float(os.getenv("CACHE_WARM_AHEAD", 60 * 60))
+
+logger = logging.getLogger(__name__)
+
+
+async def warm_cache(
+    top_n: int = CACHE_WARM_TOP_N,
+    ahead: float = CACHE_WARM_AHEAD_SECONDS,
+) -> int:
+    """
+    Refresh the most frequent queries that are missing from the cache or about to expire. Returns the number refreshed
+    """
+    cache = get_search_cache()
+
+    refreshed = 0
+
+    # queries are refreshed one at a time so warming doesn't compete with students' searches
+    for key, query in await get_query_stats().top_async(top_n):
+        expires_at = await cache.expires_at_async(key)
+
+        if expires_at is not None and expires_at - time.time() > ahead:
+            continue
+
+        try:
+            # shares the search with students searching for the same query at the same time. Once the lock is held
+            # the cached entry is only used if another worker has already refreshed it
+            await get_search_flight().run(key, lambda: refresh_search(query), lambda: load_search(key, ahead))
+            refreshed += 1
+        except Exception as e:
+            logger.warning(f"Error warming cache for '{query}': {e!r}")
+
+    return refreshed
+
+
+async def run_cache_warmer(interval: float = CACHE_WARM_INTERVAL_SECONDS):
+    while True:
+        try:
+            refreshed = await warm_cache()
+
+            logger.info(f" Cache warmer refreshed {refreshed} queries")
+        except Exception:
+            logger.exception("Error warming cache")
+
+        await asyncio.sleep(interval)
+
+
+def start_cache_warmer(interval: float = CACHE_WARM_INTERVAL_SECONDS) -> asyncio.Task | None:
+    """
+    Start warming the cache in the background, immediately and then every interval seconds. Returns None if disabled
+    """
+    if interval <= 0:
+        return None
+
+    return asyncio.create_task(run_cache_warmer(interval))
@@ -5,9 +5,23 @@ import os
 
 import logging
 
-import requests
+import asyncio
+
+import random
+
+import time
+
+import uuid
+
+from email.utils import parsedate_to_datetime
+
+from datetime import datetime, timezone
+
+import httpx
 
 from .chat import generate_response
+from .conversations import get_conversation_store, run_in_store
+from .metrics import WHATSAPP_DELIVERIES, WHATSAPP_QUEUE_LATENCY, WHATSAPP_SEND_LATENCY
 
 from dotenv import load_dotenv
 
@@ -18,94 +32,356 @@ WHATSAPP_API_VERSION = os.getenv("WHATSAPP_API_VERSION")
 WHATSAPP_ACCESS_TOKEN = os.getenv("WHATSAPP_ACCESS_TOKEN")
 PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 
-# Had issues with duplicate messages coming from Whatsapp
-# Keep track of messages being processed in a map
-PROCESSING_MESSAGES: set[str] = set()
+# Users often send several short messages in a row. Messages received within WHATSAPP_DEBOUNCE seconds of each other
+# are answered together, waiting at most WHATSAPP_DEBOUNCE_MAX seconds after the first
+WHATSAPP_DEBOUNCE_SECONDS = float(os.getenv("WHATSAPP_DEBOUNCE", 2))
+WHATSAPP_DEBOUNCE_MAX_SECONDS = float(os.getenv("WHATSAPP_DEBOUNCE_MAX", 8))
+
+# Messages received while a response is generated are answered by the same request, for up to WHATSAPP_CONVERSATION_BUDGET
+# seconds in total. Must leave headroom under the 120 second Lambda timeout in template.yaml. Another response is only
+# started if at least WHATSAPP_MIN_ANSWER seconds are left, otherwise the messages are answered with the user's next message
+WHATSAPP_CONVERSATION_BUDGET_SECONDS = float(os.getenv("WHATSAPP_CONVERSATION_BUDGET", 110))
+WHATSAPP_MIN_ANSWER_SECONDS = float(os.getenv("WHATSAPP_MIN_ANSWER", 30))
+
+# Replies are delivered from an outbound queue by WHATSAPP_SEND_WORKERS workers, through a shared connection pool.
+# The request that queued a reply waits until it has been delivered, so on Lambda it isn't left in the queue when the container is frozen
+WHATSAPP_SEND_WORKERS = int(os.getenv("WHATSAPP_SEND_WORKERS", 4))
+WHATSAPP_SEND_TIMEOUT_SECONDS = float(os.getenv("WHATSAPP_SEND_TIMEOUT", 10))
+
+# Sends that fail with a 429, 5xx or network error are retried with jittered exponential backoff,
+# or after the Retry-After header if there is one
+WHATSAPP_SEND_RETRIES = int(os.getenv("WHATSAPP_SEND_RETRIES", 4))
+WHATSAPP_RETRY_BASE_SECONDS = 0.5
+WHATSAPP_RETRY_MAX_SECONDS = 30
+
+# Maximum length of a text message, longer replies are split into several messages
+WHATSAPP_MAX_MESSAGE_LENGTH = 4096
 
 
 logger = logging.getLogger()
 
-def log_http_response(response):
-    logger.info(f"Status: {response.status_code}")
-    logger.info(f"Content-type: {response.headers.get('content-type')}")
-    logger.info(f"Body: {response.text}")
 
+_http_client: httpx.AsyncClient | None = None
 
-def send_message(data):
-    headers = {
-        "Content-type": "application/json",
-        "Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}",
-    }
+# one queue per worker, each user's replies always go to the same queue so they are delivered in order
+_queues: list[asyncio.Queue] = []
+_workers: list[asyncio.Task] = []
 
-    url = f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{PHONE_NUMBER_ID}/messages"
 
-    try:
-        response = requests.post(
-            url,
-            headers=headers,
-            json=data,
-            timeout=10
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Shared client for the Whatsapp API, so keep-alive connections are reused between messages
+    """
+    global _http_client
+
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            base_url=f"https://graph.facebook.com/{WHATSAPP_API_VERSION}/{PHONE_NUMBER_ID}",
+            headers={"Authorization": f"Bearer {WHATSAPP_ACCESS_TOKEN}"},
+            timeout=WHATSAPP_SEND_TIMEOUT_SECONDS,
         )
 
-        response.raise_for_status()
+    return _http_client
+
+
+def retry_delay(attempt: int, response: httpx.Response | None = None) -> float:
+    retry_after = response.headers.get("Retry-After") if response is not None else None
 
-    except requests.Timeout:
-        logger.error("Timeout occurred while sending message")
-        raise Exception("Request timed out")
+    if retry_after is not None:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            # may also be a date
+            try:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
 
-    except requests.RequestException as e:  # This will catch any general request exception
-        logger.error(f"Request failed due to: {e}")
-        raise Exception("Failed to send message")
+        if delay is not None:
+            return min(max(delay, 0), WHATSAPP_RETRY_MAX_SECONDS)
 
-    else:
-        # Process the response as normal
-        log_http_response(response)
-        return response
+    # full jitter, so retries from different workers don't arrive together
+    return random.uniform(0, min(WHATSAPP_RETRY_BASE_SECONDS * 2 ** attempt, WHATSAPP_RETRY_MAX_SECONDS))
 
 
-def process_whatsapp_message(body):
+async def send_message(data):
+    for attempt in range(WHATSAPP_SEND_RETRIES + 1):
+        response = None
+
+        try:
+            response = await get_http_client().post("/messages", json=data)
+
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+
+                logger.info(f"Message sent, status {response.status_code}")
+                return response
+
+            logger.warning(f"Whatsapp returned {response.status_code}")
+
+        except httpx.HTTPStatusError as e:
+            # other client errors won't succeed if retried
+            logger.error(f"Request failed due to: {e}. Body: {e.response.text[:500]}")
+            WHATSAPP_DELIVERIES["failed"] += 1
+            raise Exception("Failed to send message")
+
+        except httpx.TransportError as e: # timeouts and connection errors
+            logger.warning(f"Request failed due to: {e!r}")
+
+        if attempt < WHATSAPP_SEND_RETRIES:
+            WHATSAPP_DELIVERIES["retried"] += 1
+            await asyncio.sleep(retry_delay(attempt, response))
+
+    WHATSAPP_DELIVERIES["failed"] += 1
+    raise Exception(f"Failed to send message after {WHATSAPP_SEND_RETRIES + 1} attempts")
+
+
+def split_message(
+    text: str,
+    limit: int = WHATSAPP_MAX_MESSAGE_LENGTH,
+) -> list[str]:
     """
-    Extract fields from request body, generate response, and send reply
+    Split text into messages no longer than limit, between paragraphs, lines or words where possible.
+    Whatsapp rejects messages with an empty body, so no part is empty
     """
-    try:
-        # see Whatsapp payload structure below
-        # https://developers.facebook.com/docs/whatsapp/cloud-api/webhooks/payload-examples#text-messages
-        wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
-        name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
+    parts = []
 
-        message = body["entry"][0]["changes"][0]["value"]["messages"][0]
+    text = text.strip()
 
-        if message["type"] != "text":
-            logger.info("Non-text message was received")
-            return
+    while len(text) > limit:
+        for separator in ("\n\n", "\n", " "):
+            cut = text.rfind(separator, 0, limit)
 
-        text = message["text"]["body"]
+            if cut > 0:
+                break
+        else:
+            cut = limit
 
-        key = f"{wa_id}:{text}"
+        part = text[:cut].rstrip()
 
-        if key in PROCESSING_MESSAGES:
-            logger.info("Received duplicate message")
-            return
+        if part:
+            parts.append(part)
+
+        text = text[cut:].lstrip()
 
-        PROCESSING_MESSAGES.add(key)
+    if text:
+        parts.append(text)
 
-        response = generate_response(text, wa_id, name)
+    return parts
 
-        data = {
+
+async def deliver_reply(wa_id: str, response: str):
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+
+    parts = split_message(response)
+
+    # parts are sent one after the other so they arrive in order
+    for part in parts:
+        await send_message({
             "messaging_product": "whatsapp",
             "recipient_type": "individual",
             "to": wa_id,
             "type": "text",
             "text": {
                 "preview_url": False,
-                "body": response
+                "body": part
             },
-        }
+        })
+
+    WHATSAPP_DELIVERIES["replies"] += 1
+    WHATSAPP_DELIVERIES["messages"] += len(parts)
+    WHATSAPP_SEND_LATENCY.record(loop.time() - started_at)
+
+    logger.info(f"Reply delivered in {len(parts)} messages. Delivery: {WHATSAPP_SEND_LATENCY.summary()} Queued: {WHATSAPP_QUEUE_LATENCY.summary()}")
+
+
+async def send_reply(wa_id: str, response: str):
+    """
+    Queue a reply and wait until it has been delivered, or deliver it now if the senders haven't been started.
+    Raises if the reply could not be delivered
+    """
+    if not _queues:
+        await deliver_reply(wa_id, response)
+        return
+
+    loop = asyncio.get_running_loop()
+    delivered = loop.create_future()
+
+    await _queues[hash(wa_id) % len(_queues)].put((wa_id, response, loop.time(), delivered))
+
+    await delivered
+
+
+async def _send_worker(queue: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+
+    while True:
+        wa_id, response, queued_at, delivered = await queue.get()
+
+        # the request waiting on the reply may have been cancelled, so the future is only set if it isn't done.
+        # Errors are logged by the request
+        try:
+            WHATSAPP_QUEUE_LATENCY.record(loop.time() - queued_at)
+
+            await deliver_reply(wa_id, response)
+
+            if not delivered.done():
+                delivered.set_result(None)
+
+        except Exception as e:
+            if not delivered.done():
+                delivered.set_exception(e)
+
+        finally:
+            # if the worker is stopped while delivering, the request stops waiting
+            delivered.cancel()
+
+            queue.task_done()
+
 
-        send_message(data)
+def start_senders(workers: int = WHATSAPP_SEND_WORKERS):
+    """
+    Start the workers that deliver queued replies
+    """
+    if _workers:
+        return
+
+    for _ in range(workers):
+        queue = asyncio.Queue()
+
+        _queues.append(queue)
+        _workers.append(asyncio.create_task(_send_worker(queue)))
+
+
+async def stop_senders(timeout: float = WHATSAPP_SEND_TIMEOUT_SECONDS):
+    """
+    Deliver replies that are already queued, then stop the workers and close the connection pool
+    """
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in _queues)), timeout)
+    except TimeoutError:
+        logger.warning("Stopped before all queued replies were delivered")
+
+    for worker in _workers:
+        worker.cancel()
+
+    # requests waiting on replies that weren't delivered stop waiting
+    for queue in _queues:
+        while not queue.empty():
+            queue.get_nowait()[3].cancel()
+
+    _queues.clear()
+    _workers.clear()
 
-        PROCESSING_MESSAGES.remove(key)
+    if _http_client is not None:
+        await _http_client.aclose()
+
+
+async def wait_for_pending(wa_id: str):
+    """
+    Wait until the user has stopped sending messages for the debounce window
+    """
+    store = get_conversation_store()
+
+    while True:
+        pending = await run_in_store(store.pending, wa_id)
+
+        if not pending.messages:
+            return
+
+        remaining = min(
+            pending.last_received_at + WHATSAPP_DEBOUNCE_SECONDS,
+            pending.first_received_at + WHATSAPP_DEBOUNCE_MAX_SECONDS,
+        ) - time.time()
+
+        if remaining <= 0:
+            return
+
+        await asyncio.sleep(remaining)
+
+
+async def answer_conversation(
+    wa_id: str,
+    name: str | None,
+    owner: str, # id of the request holding the claim on the conversation
+):
+    """
+    Answer the user's pending messages until there are none left, or until the request's time budget has been used
+    """
+    store = get_conversation_store()
+
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + WHATSAPP_CONVERSATION_BUDGET_SECONDS
+
+    released = False
+
+    try:
+        while True:
+            await wait_for_pending(wa_id)
+
+            messages = await run_in_store(store.take, wa_id, owner)
+
+            # the claim has expired and passed to another request, which answers the messages instead
+            if messages is None:
+                released = True
+                return
+
+            if messages:
+                if len(messages) > 1:
+                    logger.info(f"Answering {len(messages)} messages together")
+
+                try:
+                    response = await generate_response("\n".join(messages), wa_id, name, timeout=deadline - loop.time())
+
+                    await send_reply(wa_id, response)
+
+                except Exception as e:
+                    logger.error("Error sending message. This is an error with Whatsapp. Details below.")
+                    logger.error(e)
+
+            # messages received while answering are answered next, if there is time left to answer them
+            if await run_in_store(store.release, wa_id, owner):
+                released = True
+                return
+
+            if deadline - loop.time() < WHATSAPP_MIN_ANSWER_SECONDS:
+                logger.warning("Out of time to answer further messages, they will be answered with the user's next message")
+                return
+
+    finally:
+        if not released:
+            await run_in_store(store.release, wa_id, owner, True)
+
+
+async def process_whatsapp_message(body):
+    """
+    Extract fields from request body, generate response, and send reply
+    """
+    try:
+        # see Whatsapp payload structure below
+        # https://developers.facebook.com/docs/whatsapp/cloud-api/webhooks/payload-examples#text-messages
+        wa_id = body["entry"][0]["changes"][0]["value"]["contacts"][0]["wa_id"]
+        name = body["entry"][0]["changes"][0]["value"]["contacts"][0]["profile"]["name"]
+
+        message = body["entry"][0]["changes"][0]["value"]["messages"][0]
+
+        if message["type"] != "text":
+            logger.info("Non-text message was received")
+            return
+
+        # duplicate deliveries are filtered out by the webhook route, see services/idempotency.py
+        text = message["text"]["body"]
 
     except Exception as e:
-        logger.error("Error sending message. This is an error with Whatsapp. Details below.")
-        logger.error(e)
+        logger.error(f"Error reading message: {e!r}")
+        return
+
+    owner = uuid.uuid4().hex
+
+    # if another request, possibly in another container, is answering this user it answers this message too
+    if not await run_in_store(get_conversation_store().add, wa_id, text, owner):
+        return
+
+    # the request holding the claim answers the whole conversation, so the work is done within a request
+    await answer_conversation(wa_id, name, owner)
@@ -0,0 +1,102 @@
+"""
+This script compares the html extractors in app/services/extract.py on saved pages.
+For each extractor it reports the time taken per page, throughput, and whether the text matches the original BeautifulSoup extractor.
+Save more pages to compare with --save, e.g. python scripts/benchmark_extract.py --save https://hilton.edu.au/
+"""
+import os
+
+import sys
+
+import time
+
+import argparse
+
+from glob import glob
+
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from services.extract import EXTRACTORS, SoupExtractor
+
+FIXTURES_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "pages")
+
+
+def save_page(url: str):
+    import httpx
+
+    response = httpx.get(url, follow_redirects=True)
+    response.raise_for_status()
+
+    parts = urlsplit(url)
+    name = f"{parts.netloc}{parts.path}".strip("/").replace("/", "_") or "index"
+
+    with open(os.path.join(FIXTURES_DIRECTORY, f"{name}.html"), "w", encoding="utf-8") as f:
+        f.write(response.text)
+
+    print("Saved: ", url)
+
+
+def similarity(a: str, b: str) -> float:
+    """
+    Proportion of lines shared by both texts
+    """
+    a, b = set(a.splitlines()), set(b.splitlines())
+
+    return len(a & b) / len(a | b) if a | b else 1.0
+
+
+def benchmark(pages: dict[str, str], iterations: int):
+    expected = {name: SoupExtractor().extract(html) for name, html in pages.items()}
+    total_bytes = sum(len(html.encode("utf-8")) for html in pages.values())
+
+    print(f"{len(pages)} pages, {total_bytes / 1024:.0f} KB, {iterations} iterations\n")
+    print(f"{'extractor':<12}{'ms/page':>10}{'MB/s':>10}{'matches':>10}{'similarity':>12}")
+
+    for name, extractor_class in EXTRACTORS.items():
+        try:
+            extractor = extractor_class()
+        except ImportError:
+            print(f"{name:<12}{'not installed':>42}")
+            continue
+
+        outputs = {page: extractor.extract(html) for page, html in pages.items()}
+
+        start = time.perf_counter()
+
+        for _ in range(iterations):
+            for html in pages.values():
+                extractor.extract(html)
+
+        elapsed = time.perf_counter() - start
+
+        matches = sum(outputs[page] == expected[page] for page in pages)
+        mean_similarity = sum(similarity(outputs[page], expected[page]) for page in pages) / len(pages)
+
+        print(
+            f"{name:<12}{1000 * elapsed / (iterations * len(pages)):>10.2f}{iterations * total_bytes / elapsed / 1e6:>10.1f}"
+            f"{f'{matches}/{len(pages)}':>10}{mean_similarity:>12.3f}"
+        )
+
+        for page in pages:
+            if outputs[page] != expected[page]:
+                print(f"  differs from soup on {page}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark html extractors")
+    parser.add_argument("--save", nargs="+", metavar="URL", help="save pages as fixtures before running")
+    parser.add_argument("--iterations", type=int, default=50)
+
+    args = parser.parse_args()
+
+    for url in args.save or []:
+        save_page(url)
+
+    pages = {}
+
+    for path in sorted(glob(os.path.join(FIXTURES_DIRECTORY, "*.html"))):
+        with open(path, encoding="utf-8") as f:
+            pages[os.path.basename(path)] = f.read()
+
+    benchmark(pages, args.iterations)
@@ -0,0 +1,39 @@
+"""
+This script crawls the partner colleges' websites into the local knowledge index used by the search tool.
+Run it again to refresh the index, unchanged pages are revalidated without being re-indexed.
+"""
+import os
+
+import sys
+
+import asyncio
+
+import argparse
+
+import logging
+
+# run from the app folder so the index is written where the app reads it, and is copied into the image with it
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+sys.path.insert(0, APP_DIRECTORY)
+os.chdir(APP_DIRECTORY)
+
+from services.index import CRAWL_MAX_PAGES_PER_SITE, SITES, crawl
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build or refresh the local knowledge index")
+    parser.add_argument("--site", action="append", choices=list(SITES), help="crawl only this site, can be repeated")
+    parser.add_argument("--max-pages", type=int, default=CRAWL_MAX_PAGES_PER_SITE, help="maximum pages crawled per site")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    stats = asyncio.run(crawl(args.site, max_pages=args.max_pages))
+
+    print("Index updated: ", dict(stats))
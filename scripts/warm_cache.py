@@ -0,0 +1,39 @@
+"""
+This script refreshes the most frequent searches in the search cache before they expire.
+Run it on a schedule, e.g. with cron, as an alternative to setting CACHE_WARM_INTERVAL in the app.
+"""
+import os
+
+import sys
+
+import asyncio
+
+import argparse
+
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# run from the app folder so the cache is read from where the app keeps it
+APP_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+
+sys.path.insert(0, APP_DIRECTORY)
+os.chdir(APP_DIRECTORY)
+
+from services.warmer import CACHE_WARM_AHEAD_SECONDS, CACHE_WARM_TOP_N, warm_cache
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the most frequent searches in the cache")
+    parser.add_argument("--top", type=int, default=CACHE_WARM_TOP_N, help="number of most frequent queries to keep warm")
+    parser.add_argument("--ahead", type=float, default=CACHE_WARM_AHEAD_SECONDS, help="refresh entries expiring within this many seconds")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    refreshed = asyncio.run(warm_cache(args.top, args.ahead))
+
+    print("Queries refreshed: ", refreshed)